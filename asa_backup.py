@@ -45,6 +45,7 @@
 # ----------------------------------------------------------------------------
 
 CONFIG_FILE = "~/.asa_backup.yaml"
+DIFF_MAX_LINES = 1000
 CONFIG_DEFAULT = """---
 # CISCO ASA FIREWALLS BACKUP CONFIGURATION
 #
@@ -70,6 +71,7 @@ firewalls:
   asa1:
     hostname: asa1-admin.example.com
     enable-secret: YoUr.EnAbLeSeCrEt.HeRe
+    # standby-hostname: asa1-standby.example.com
   asa2:
     hostname: asa2-admin.example.com
     enable-secret: YoUr.EnAbLeSeCrEt.HeRe
@@ -83,44 +85,169 @@ firewalls:
 # Netmiko: https://github.com/ktbyers/netmiko
 
 import argparse
-import yaml
+import bisect
+import contextlib
+import contextvars
+import hashlib
+import json
 import os
+import queue
 import re
+import multiprocessing
+import shlex
+import shutil
 import socket
-import subprocess
+import sqlite3
+import stat
 import sys
+import tempfile
+import threading
+import time
 import difflib
+import glob
+import gzip
+import lzma
+import zlib
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
-from netmiko import ConnectHandler
-from pprint import pprint
 
 
 
 # ----------------------------------------------------------------------------
-# is_resolvable
+# log
 # ----------------------------------------------------------------------------
-# Returns True if the hostname is resolvable via DNS. False otherwise.
+# Print a message to stdout. When firewalls are backed up concurrently each
+# job sets its own prefix (the firewall name), so every line of its output
+# stream can be told apart. Lines are written under a lock and never
+# interleave with the output of other jobs.
 #
-def is_resolvable(host):
+LOG_LOCK = threading.Lock()
+LOG_PREFIX = contextvars.ContextVar("log_prefix", default="")
+
+def log(message=""):
+    prefix = LOG_PREFIX.get()
+    lines = str(message).split('\n')
+    with LOG_LOCK:
+        for line in lines:
+            sys.stdout.write(f"{prefix}{line}\n")
+        sys.stdout.flush()
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# measure
+# ----------------------------------------------------------------------------
+# Context manager measuring the wall-clock time of a phase of the backup
+# (connect, discover, tech-support, config, backup, verify). Yields the record
+# with phase, labels, seconds and bytes, the caller may fill in the bytes.
+# The record is added to the run report of the current job (see REPORT and
+# write_report). Helper threads see the report through contextvars.
+#
+REPORT = contextvars.ContextVar("report", default=None)
+
+@contextlib.contextmanager
+def measure(phase, **labels):
+    record = { "phase": phase, **labels, "seconds": 0.0, "bytes": 0 }
+    start = time.monotonic()
     try:
-        socket.gethostbyname(host)
-        return(True)
-    except socket.error:
-        return(False)
+        yield record
+    finally:
+        record["seconds"] = round(time.monotonic() - start, 3)
+        if (report := REPORT.get()) is not None:
+            report["phases"].append(record)
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# command_labels
+# ----------------------------------------------------------------------------
+# Returns the measure labels of a collection command: phase, unit, context,
+# step (first word of the command) and file. The file is taken from the
+# last argument, the phase and context from the filename. The command itself
+# is not recorded, it may contain passwords.
+#
+def command_labels(command, unit):
+    file = re.split(r'[/:]', command.split()[-1].split(";")[0])[-1]
+    labels = {
+        "phase":   "config",
+        "unit":    unit,
+        "context": None,
+        "step":    command.split()[0],
+        "file":    file,
+    }
+    if file.startswith("tech-support"):
+        labels["phase"] = "tech-support"
+    elif match := re.match(rf'(backup|context)_(.+)_{unit}\.', file):
+        labels["phase"] = "backup" if match.group(1) == "backup" else "config"
+        labels["context"] = match.group(2)
+    elif file.startswith("backup_"):
+        labels["phase"] = "backup"
+    return(labels)
+
+
+
+# ----------------------------------------------------------------------------
+# check_host_async
+# ----------------------------------------------------------------------------
+# Resolve a host via DNS and open a TCP connection to its SSH port, trying
+# the addresses in turn. Returns a tuple of the first address that accepted
+# the connection and None, or None and the reason the host failed.
+#
+async def check_host_async(host, port, timeout):
+    loop = asyncio.get_running_loop()
+    try:
+        infos = await asyncio.wait_for(loop.getaddrinfo(host, port,
+            type=socket.SOCK_STREAM), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return(None, "not resolvable")
+    for address in dict.fromkeys(info[4][0] for info in infos):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(address, port), timeout)
+        except (OSError, asyncio.TimeoutError):
+            continue
+        writer.close()
+        with contextlib.suppress(OSError):
+            await writer.wait_closed()
+        return(address, None)
+    return(None, f"not reachable on port {port}")
 
 
 
 # ----------------------------------------------------------------------------
-# is_host_reachable 
+# preflight_firewalls
 # ----------------------------------------------------------------------------
-# Check if a host is reachable.
-# Returns: True if the host is reachable, False otherwise
+# Check all firewalls at once before the backup starts and report the
+# unreachable ones up front. Stores the address that accepted the connection
+# as "address" in the config of each firewall, it is used for all SSH
+# sessions of the run. Firewalls that failed get the reason as "unreachable"
+# and are reported as failed by prepare_firewall.
+# This is the first use of asyncio in a backup run, it is imported here for
+# the whole module (also for the asyncio engine), so the commands without
+# SSH start without it.
 #
-def is_host_reachable(host):
-    result = subprocess.run(['ping', '-c', '1', host], 
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return(result.returncode == 0)
+def preflight_firewalls(cfg, firewalls):
+    global asyncio
+    import asyncio
+
+    async def check_all():
+        checks = [ check_host_async(cfg["firewalls"][fw].hostname, cfg["firewalls"][fw].port,
+            cfg["firewalls"][fw].preflight_timeout) for fw in firewalls ]
+        return(await asyncio.gather(*checks))
+    start = time.monotonic()
+    results = asyncio.run(check_all())
+    for fw, (address, error) in zip(firewalls, results):
+        cfg["firewalls"][fw].address = address
+        cfg["firewalls"][fw].unreachable = error
+        if error:
+            log(f"ERROR: Host {cfg['firewalls'][fw].hostname} of {fw} is {error}!")
+    reachable = sum(1 for address, error in results if address)
+    log(f"Preflight: {reachable} of {len(firewalls)} firewalls reachable "
+        f"({time.monotonic() - start:.1f} seconds).")
+    return
 
 
 
@@ -148,29 +275,298 @@ def write_default_config_file():
 
 
 # ----------------------------------------------------------------------------
-# read_configfile
+# CONFIG_OPTIONS
 # ----------------------------------------------------------------------------
-# Read configuration file in YAML format and set default values if not
-# defined. Simplifies further code and error checking. :-)
-# Returns a dict with the configuration parameters.
+# Options of a firewall with their type and default value. Options with
+# default REQUIRED must be set in the defaults, a group or the firewall.
+# Options in CONFIG_CHOICES only take one of the listed values (or None).
+# Options in ENGINE_UNSUPPORTED must not be set for firewalls backed up with
+# that engine (see check_engine).
 #
-def read_configfile(file_path):
-    cfg = []
+REQUIRED = "<required>"
+
+CONFIG_OPTIONS = {
+    "hostname":            (str,            REQUIRED),
+    "port":                (int,            22),
+    "device-type":         (str,            "cisco_asa"),
+    "username":            (str,            REQUIRED),
+    "password":            (str,            REQUIRED),
+    "enable-secret":       (str,            REQUIRED),
+    "use-key":             (bool,           False),
+    "ssh-key":             (str,            "~/.ssh/id_rsa"),
+    "conn-timeout":        (int,            30),
+    "read-timeout":        (int,            1800),
+    "keepalive":           (int,            30),
+    "retries":             (int,            0),
+    "retry-delay":         ((int, float),   5),
+    "preflight-timeout":   ((int, float),   5),
+    "backup-host":         (str,            REQUIRED),
+    "backup-username":     (str,            REQUIRED),
+    "backup-password":     (str,            REQUIRED),
+    "backup-dir":          (str,            REQUIRED),
+    "backup-host-jobs":    (int,            0),
+    "standby-hostname":    (str,            None),
+    "pipeline-depth":      (int,            0),
+    "incremental":         (bool,           False),
+    "storage":             (str,            "slots"),
+    "facts-ttl":           (int,            0),
+    "receiver":            (str,            None),
+    "receiver-host-key":   (str,            "~/.asa_backup_host_key"),
+    "tech-support-stream": (bool,           False),
+    "diff-max-lines":      (int,            DIFF_MAX_LINES),
+    "diff-mode":           (str,            "text"),
+    "history":             (bool,           False),
+    "compression":         (str,            None),
+    "resume":              (bool,           False),
+}
+CONFIG_CHOICES = {
+    "storage":     ( "slots", "objects" ),
+    "receiver":    ( "embedded", ),
+    "diff-mode":   ( "text", "semantic" ),
+    "compression": ( "xz", "zstd" ),
+}
+ENGINE_UNSUPPORTED = {
+    "asyncio": ( "standby-hostname", "pipeline-depth", "incremental" ),
+}
+
+
+
+# ----------------------------------------------------------------------------
+# FirewallConfig
+# ----------------------------------------------------------------------------
+# Resolved config of one firewall, with every option of CONFIG_OPTIONS set.
+# Options are attributes with underscores (fw.read_timeout), the slots keep
+# thousands of them small. For the code written against the plain dicts,
+# options can also be read and set by their name (fw["read-timeout"],
+# fw.get("port")). Address and unreachable are set by preflight_firewalls.
+#
+class FirewallConfig:
+    __slots__ = ( "name", "address", "unreachable" ) + tuple(
+        option.replace("-", "_") for option in CONFIG_OPTIONS)
+
+    def __init__(self, name, options):
+        self.name = name
+        self.address = None
+        self.unreachable = None
+        for option, value in options.items():
+            setattr(self, option.replace("-", "_"), value)
+
+    def __getitem__(self, key):
+        try:
+            return(getattr(self, key.replace("-", "_")))
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key.replace("-", "_"), value)
+
+    def __contains__(self, key):
+        return(hasattr(self, key.replace("-", "_")))
+
+    def get(self, key, default=None):
+        try:
+            return(self[key])
+        except KeyError:
+            return(default)
+
+
+
+# ----------------------------------------------------------------------------
+# load_config_file
+# ----------------------------------------------------------------------------
+# Read a YAML config file and the files it includes into raw, a dict with
+# defaults, groups and firewalls. The include list holds file names or glob
+# patterns, relative to the including file. Included files are read first,
+# so the including file overrides their defaults and groups. A firewall may
+# only be defined once. The modification time of every file read (and of
+# the directory of every pattern) is recorded in files, see
+# read_config_cache. Raises ValueError on errors.
+#
+def load_config_file(file_path, raw, files):
+    import yaml
+    file_path = os.path.abspath(os.path.expanduser(file_path))
+    if file_path in files:
+        raise ValueError(f"{file_path} is included more than once")
     try:
-        if not file_path:
-            file_path = os.path.expanduser(CONFIG_FILE)
+        files[file_path] = os.stat(file_path).st_mtime_ns
         with open(file_path, 'r') as file:
-            cfg = yaml.safe_load(file)
+            data = yaml.safe_load(file) or {}
     except yaml.YAMLError as e:
-        sys.exit(f"YAML format error: {e}")
-    except Exception as e:
-        sys.exit(f"ERROR: Reading config failed: {e}")
-    else:
-        # Add defaults to firewall specific config if not set.
-        for fw in cfg["firewalls"]:
-            for key in cfg["defaults"]:
-                if key not in cfg["firewalls"][fw]:
-                    cfg["firewalls"][fw][key] = cfg["defaults"][key]
+        raise ValueError(f"YAML format error: {e}")
+    except OSError as e:
+        raise ValueError(f"Reading {file_path} failed: {e}")
+    if not isinstance(data, dict) or set(data) - { "include", "defaults", "groups", "firewalls" }:
+        raise ValueError(f"{file_path}: only include, defaults, groups and firewalls are allowed")
+    includes = data.get("include") or []
+    for pattern in [ includes ] if isinstance(includes, str) else includes:
+        pattern = os.path.join(os.path.dirname(file_path), os.path.expanduser(pattern))
+        paths = sorted(glob.glob(pattern))
+        if glob.has_magic(pattern):
+            directory = os.path.dirname(pattern)
+            if os.path.isdir(directory):
+                files[directory] = os.stat(directory).st_mtime_ns
+        elif not paths:
+            raise ValueError(f"{file_path}: included file {pattern} not found")
+        for path in paths:
+            load_config_file(path, raw, files)
+    raw["defaults"].update(data.get("defaults") or {})
+    for group, options in (data.get("groups") or {}).items():
+        raw["groups"].setdefault(group, {}).update(options or {})
+    for fw, options in (data.get("firewalls") or {}).items():
+        if fw in raw["firewalls"]:
+            raise ValueError(f"{file_path}: firewall {fw} is already defined")
+        raw["firewalls"][fw] = options or {}
+    return(raw)
+
+
+
+# ----------------------------------------------------------------------------
+# check_options
+# ----------------------------------------------------------------------------
+# Check the options of the defaults, a group or a firewall (where) against
+# CONFIG_OPTIONS. Unknown options are reported with the closest known
+# option, as they are usually typos. Numbers are accepted for strings, e. g.
+# numeric passwords. Returns dict with the checked options, adds the
+# messages to errors.
+#
+def check_options(where, options, errors):
+    checked = {}
+    for option, value in options.items():
+        if option not in CONFIG_OPTIONS:
+            close = difflib.get_close_matches(option, CONFIG_OPTIONS, 1)
+            hint = f", did you mean {close[0]}?" if close else ""
+            errors.append(f"{where}: unknown option {option}{hint}")
+            continue
+        kind = CONFIG_OPTIONS[option][0]
+        if kind is str and isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = str(value)
+        if value is not None and (not isinstance(value, kind) or
+                                  (isinstance(value, bool) and kind is not bool)):
+            errors.append(f"{where}: option {option} must be of type "
+                f"{' or '.join(k.__name__ for k in (kind if isinstance(kind, tuple) else (kind,)))}")
+            continue
+        if value is not None and value not in CONFIG_CHOICES.get(option, (value,)):
+            errors.append(f"{where}: option {option} must be one of {', '.join(CONFIG_CHOICES[option])}")
+            continue
+        checked[option] = value
+    return(checked)
+
+
+
+# ----------------------------------------------------------------------------
+# compile_config
+# ----------------------------------------------------------------------------
+# Resolve the raw config (see load_config_file) into a FirewallConfig per
+# firewall: defaults, then the groups of the firewall in the given order
+# (group: name or a list of names), then its own options and the defaults
+# of CONFIG_OPTIONS for options set nowhere. Returns dict with defaults,
+# groups and firewalls, raises ValueError with all errors found.
+#
+def compile_config(raw):
+    errors = []
+    defaults = check_options("defaults", raw["defaults"], errors)
+    groups = { group: check_options(f"group {group}", options, errors)
+               for group, options in raw["groups"].items() }
+    firewalls = {}
+    for fw, options in raw["firewalls"].items():
+        options = dict(options)
+        names = options.pop("group", [])
+        resolved = dict(defaults)
+        for group in [ names ] if isinstance(names, str) else names:
+            if group not in groups:
+                errors.append(f"firewall {fw}: unknown group {group}")
+                continue
+            resolved.update(groups[group])
+        resolved.update(check_options(f"firewall {fw}", options, errors))
+        for option, (kind, default) in CONFIG_OPTIONS.items():
+            if resolved.get(option) is None and default is REQUIRED:
+                errors.append(f"firewall {fw}: option {option} is required")
+            resolved.setdefault(option, default)
+        firewalls[fw] = FirewallConfig(fw, resolved)
+    if errors:
+        raise ValueError("\n".join(errors))
+    return({ "defaults": defaults, "groups": groups, "firewalls": firewalls })
+
+
+
+# ----------------------------------------------------------------------------
+# read_config_cache
+# ----------------------------------------------------------------------------
+# Returns the compiled config from the JSON cache file, or None if there is
+# none, it belongs to another user or any of the files it was compiled from
+# (config files, directories of include patterns and this script) has
+# changed since. The firewalls are rebuilt from their resolved options.
+#
+def read_config_cache(cache_path):
+    try:
+        with open(cache_path, 'r') as file:
+            if os.fstat(file.fileno()).st_uid != os.getuid():
+                return(None)
+            cache = json.load(file)
+        for path, mtime in cache["files"].items():
+            if os.stat(path).st_mtime_ns != mtime:
+                return(None)
+        firewalls = { fw: FirewallConfig(fw, options) for fw, options in cache["firewalls"].items() }
+        return({ "defaults": cache["defaults"], "groups": cache["groups"], "firewalls": firewalls })
+    except Exception:
+        return(None)
+
+
+
+# ----------------------------------------------------------------------------
+# write_config_cache
+# ----------------------------------------------------------------------------
+# Write the compiled config with the modification times of its files to the
+# cache file as JSON, readable by the owner only as it holds the passwords.
+# All options are plain values, the firewalls are stored with their
+# resolved options. A cache that cannot be written is skipped.
+#
+def write_config_cache(cache_path, cfg, files):
+    files = dict(files)
+    files[os.path.abspath(__file__)] = os.stat(__file__).st_mtime_ns
+    cache = {
+        "files":     files,
+        "defaults":  cfg["defaults"],
+        "groups":    cfg["groups"],
+        "firewalls": { fw: { option: fwcfg[option] for option in CONFIG_OPTIONS }
+                       for fw, fwcfg in cfg["firewalls"].items() },
+    }
+    try:
+        fd = os.open(cache_path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as file:
+            json.dump(cache, file)
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(cache_path + ".tmp")
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# read_configfile
+# ----------------------------------------------------------------------------
+# Read configuration file in YAML format with its includes, check it and
+# resolve the config of every firewall once (see compile_config). The
+# result is cached in <file>.cache and used as long as no file changed, so
+# large inventories load without parsing YAML. Aborts on errors.
+# Returns a dict with defaults, groups and firewalls (name ->
+# FirewallConfig).
+#
+def read_configfile(file_path):
+    if not file_path:
+        file_path = os.path.expanduser(CONFIG_FILE)
+    cache_path = os.path.abspath(file_path) + ".cache"
+    cfg = read_config_cache(cache_path)
+    if cfg is not None:
+        return(cfg)
+    files = {}
+    try:
+        raw = load_config_file(file_path, { "defaults": {}, "groups": {}, "firewalls": {} }, files)
+        cfg = compile_config(raw)
+    except ValueError as e:
+        sys.exit(f"ERROR: Reading config failed:\n{e}")
+    write_config_cache(cache_path, cfg, files)
     return(cfg)
 
 
@@ -197,6 +593,26 @@ def validate_firewalls(cfg, args_firewalls):
 
 
 
+# ----------------------------------------------------------------------------
+# check_engine
+# ----------------------------------------------------------------------------
+# Check that the firewalls set no option the engine does not support (see
+# ENGINE_UNSUPPORTED), before any firewall is connected. Aborts with all
+# errors found.
+#
+def check_engine(cfg, firewalls, engine):
+    errors = []
+    for fw in sorted(firewalls):
+        fwcfg = cfg["firewalls"][fw]
+        for option in ENGINE_UNSUPPORTED.get(engine, ()):
+            if fwcfg[option]:
+                errors.append(f"firewall {fw}: option {option} is not supported by the {engine} engine")
+    if errors:
+        sys.exit("ERROR: Reading config failed:\n" + "\n".join(errors))
+    return
+
+
+
 # ----------------------------------------------------------------------------
 # get_retention_slot
 # ----------------------------------------------------------------------------
@@ -218,15 +634,14 @@ def get_retention_slot(dt):
 
 
 # ----------------------------------------------------------------------------
-# get_version
+# parse_version
 # ----------------------------------------------------------------------------
 # Returns the ASA software version as dict with major, minor, maintenance
 # and interim.
 # Example: Cisco Adaptive Security Appliance Software Version 9.16(3)23
 # major = 9, minor = 16, maintenance = 3, interim = 23
 #
-def get_version(conn):
-    output = conn.send_command("show version | include ^Cisco.*Appliance.*Version")
+def parse_version(output):
     digits = re.findall(r'\d+', output)
     version = {
         "major":       int(digits[0]),
@@ -239,26 +654,24 @@ def get_version(conn):
 
 
 # ----------------------------------------------------------------------------
-# get_context_mode
+# parse_context_mode
 # ----------------------------------------------------------------------------
-# Queries context mode of the ASA firewall. Change to system context if ASA
-# has multiple contexts. Returns context mode (single, multiple).
+# Returns context mode (single, multiple) from output of "show mode".
 #
-def get_context_mode(conn):
+def parse_context_mode(output):
     pattern = re.compile(r'Security context mode: (single|multiple)')
-    output = conn.send_command("show mode")
     match = pattern.search(output)
     return(match.group(1))
 
 
 
 # ----------------------------------------------------------------------------
-# get_failover_units
+# parse_failover_units
 # ----------------------------------------------------------------------------
+# Returns list of failover units, active only or active and standby.
 #
-def get_failover_units(conn):
+def parse_failover_units(output):
     units = [ "active" ]
-    output = conn.send_command("show failover | include ^Failover (On|Off)")
     if re.match(r'^Failover On', output):
         units.append("standby")
     return(units)
@@ -266,15 +679,14 @@ def get_failover_units(conn):
 
 
 # ----------------------------------------------------------------------------
-# get_contexts
+# parse_contexts
 # ----------------------------------------------------------------------------
-# Show contexts, parse output, append context names into list contexts.
-# Returns list of context names, starting with system.
+# Parse output of "show context", append context names into list contexts.
+# Returns list of context names.
 #
-def get_contexts(conn):
+def parse_contexts(output):
     pattern = re.compile(r'^[ \*]([A-Za-z0-9\-]+)')
     contexts = []
-    output = conn.send_command("show context")
     for line in output.split('\n'): 
         if match := pattern.search(line):
             contexts.append(match.group(1))
@@ -283,18 +695,30 @@ def get_contexts(conn):
 
 
 # ----------------------------------------------------------------------------
-# get_interface_hack
+# parse_config_url
+# ----------------------------------------------------------------------------
+# Returns the config-url of a context, e. g. disk0:/admin.cfg, or None.
+#
+def parse_config_url(output):
+    pattern = re.compile(r'^\s*config-url\s+(\S+)')
+    if match := pattern.search(output):
+        return(match.group(1))
+    return(None)
+
+
+
+# ----------------------------------------------------------------------------
+# parse_interface_hack
 # ----------------------------------------------------------------------------
 # In single context mode, when accessing ASA through a VPN tunnel and doing a
 # copy command, the ASA uses the public interface IP as source address. The
 # copy command then fails because traffic is not encrypted through the VPN
 # tunnel. Appending the option ";int=inside" is an undocumented hack to use
 # the inside IP address instead. Works only for the copy command, not for
-# the backup command.
+# the backup command. Returns the hack if the inside interface is up.
 #
-def get_interface_hack(conn):
+def parse_interface_hack(output):
     ihack = ""
-    output = conn.send_command("show interface inside | include ^Interface")
     if re.match(r'^Interface.*inside.*is up', output):
         ihack = ";int=inside"
     return(ihack)
@@ -302,270 +726,3356 @@ def get_interface_hack(conn):
 
 
 # ----------------------------------------------------------------------------
-# run_batch_commands
+# parse_standby_address
 # ----------------------------------------------------------------------------
-# Run array of commands on active ASA (default) or on standby unit.
+# Find the management IP address of the standby unit in "show failover". The
+# interface (and in multiple context mode the context) carrying the address
+# we are connected to is looked up in the "This host" section and the same
+# interface is looked up in the "Other host" section. Returns IP address of
+# standby unit or None if not found.
 #
-def run_batch_commands(conn, commands, unit="active"):
-    for command in commands:
-        if unit == "standby":
-            command = f"failover exec {unit} {command}"
-        output = conn.send_command(command)
-        #print(output)
-    return
+def parse_standby_address(output, address):
+    pattern = re.compile(r'^\s*(\S+\s+)?Interface\s+(\S+)\s+\(([0-9a-fA-F\.:]+)\)')
+    this_host = {}
+    other_host = {}
+    interfaces = this_host
+    for line in output.split('\n'):
+        if line.strip().startswith("This host"):
+            interfaces = this_host
+        elif line.strip().startswith("Other host"):
+            interfaces = other_host
+        elif match := pattern.match(line):
+            key = ((match.group(1) or "").strip(), match.group(2))
+            interfaces[key] = match.group(3)
+    for key, ip in this_host.items():
+        if ip == address and key in other_host:
+            return(other_host[key])
+    return(None)
 
 
 
 # ----------------------------------------------------------------------------
-# copy_tech_support
+# Discovery Commands
 # ----------------------------------------------------------------------------
-# Sending tech-support directly to scp path fails. Copy first to flash disk,
-# then copy, then delete.
+# Commands and parsers of the device facts, shared by the Netmiko and the
+# asyncio engine.
 #
-def copy_tech_support(conn, unit, backup_url, ihack):
-    print(f"Collecting tech-support on {unit} unit  ...")
-    file = f"tech-support_{unit}.txt"
-    commands = [
-        f"show tech-support file flash:/{file}",
-        f"copy /noconfirm flash:/{file} {backup_url}/{file}{ihack}",
-        f"delete /noconfirm flash:/{file}"
-    ]
-    run_batch_commands(conn, commands, unit)
-    return 
+FACT_COMMANDS = {
+    "version":        ("show version | include ^Cisco.*Appliance.*Version", parse_version),
+    "context-mode":   ("show mode", parse_context_mode),
+    "failover-units": ("show failover | include ^Failover (On|Off)", parse_failover_units),
+    "contexts":       ("show context", parse_contexts),
+}
+FAILOVER_COMMAND = "show failover"
+INTERFACE_COMMAND = "show interface inside | include ^Interface"
+CONFIG_URL_COMMAND = "show run context {} | include config-url"
 
 
 
 # ----------------------------------------------------------------------------
-# copy_config
+# query_fact_steps
 # ----------------------------------------------------------------------------
-# Copy running-config and startup-config to backup_url. In single mode it is
-# the entire configuration in multiple context mode it is only the system
-# context.
+# Steps (see run_steps) returning a device fact (see FACT_COMMANDS). It is
+# taken from the device facts if given (see load_facts), otherwise queried
+# and stored there.
 #
-def copy_config(conn, unit, backup_url, ihack, contexts):
-    print(f"Collecting config on {unit} unit ...")
-    pattern = re.compile(r'^\s*config-url\s+(\S+)')
-    commands = [
-      f"copy /noconfirm running-config {backup_url}/running-config_{unit}.cfg{ihack}",
-      f"copy /noconfirm startup-config {backup_url}/startup-config_{unit}.cfg{ihack}"
-    ]
-    # We have contexts. Also backup the context configs individually.
-    for context in contexts:
-        output = conn.send_command(f"show run context {context} | include config-url")
-        if match := pattern.search(output):
-            srcfile = match.group(1)
-            commands.append(f"copy /noconfirm {srcfile} {backup_url}/context_{context}_{unit}.cfg{ihack}")
-    run_batch_commands(conn, commands, unit)
-    return
+def query_fact_steps(facts, key):
+    if facts and key in facts:
+        return(facts[key])
+    command, parser = FACT_COMMANDS[key]
+    with measure("discover", step=key):
+        value = parser((yield command))
+    if facts is not None:
+        facts[key] = value
+    return(value)
 
 
 
 # ----------------------------------------------------------------------------
-# run_backup
+# query_fact
 # ----------------------------------------------------------------------------
-# The backup command was added with ASA version 9.3(2).
-# It contains the running-config, startup-config, certificates and if there
-# was no bug with multiple contexts, also webvpn data such as anyconnect
-# packages, but backup of WebVPN data fails in multiple contexts.
-# First run a backup to flash disk and then copy it via scp due to Cisco bug
-# CSCvh02142.
+# Returns a device fact, see query_fact_steps.
 #
-def run_backup(conn, unit, backup_url, ihack, contexts, passphrase):
-    ver = get_version(conn)
-    if not (ver["major"] >= 9 and ver["minor"] >= 3 and ver["maintenance"] >= 2):
-        print("Backup command not invented yet.")
-        return
-    if not contexts:
-        print(f"Backing up single context on {unit} unit ...")
-        file = f"backup_{unit}.tar.gz"
-        commands = [
-            f"backup /noconfirm passphrase {passphrase} location flash:/{file}",
-            f"copy /noconfirm flash:/{file} {backup_url}/{file}{ihack}",
-            f"delete /noconfirm flash:/{file}"
-        ]
-        run_batch_commands(conn, commands, unit)
-    else:
-        # We have contexts. Also backup system context.
-        for context in [ "system" ] + contexts:
-            print(f"Backing up context {context} on {unit} unit ...")
-            file = f"backup_{context}_{unit}.tar.gz"
-            commands = [
-                f"backup /noconfirm context {context} passphrase {passphrase} location flash:/{file}",
-                f"copy /noconfirm flash:/{file} {backup_url}/{file}{ihack}",
-                f"delete /noconfirm flash:/{file}"
-            ]
-            run_batch_commands(conn, commands, unit)
-    return
+def query_fact(conn, facts, key):
+    return(run_steps(conn, query_fact_steps(facts, key)))
 
 
 
 # ----------------------------------------------------------------------------
-# find_cryptochecksum 
+# get_version
 # ----------------------------------------------------------------------------
-def find_cryptochecksum(lines):
-    pattern = re.compile(r'^Cryptochecksum:([0-9a-f]+)$')
-    checksum = False
-    for line in lines:
-        if match := pattern.match(line.strip()):
-            checksum = match.group(1)
-    return(checksum)
+# Returns the ASA software version, see parse_version.
+#
+def get_version(conn, facts=None):
+    return(query_fact(conn, facts, "version"))
 
 
 
 # ----------------------------------------------------------------------------
-# compare_files
+# get_context_mode
 # ----------------------------------------------------------------------------
-def compare_files(dir, file1, file2):
-    try:
-        with open(dir + "/" + file1, 'r') as f1:
-            file1_lines = f1.readlines()
-        with open(dir + "/" + file2, 'r') as f2:
-            file2_lines = f2.readlines()
-    except Exception as e:
-        print(f"ERROR: Reading files {file1}, {file2} failed: {e}")
-    else:
-        file1_cksum = find_cryptochecksum(file1_lines)
-        file2_cksum = find_cryptochecksum(file2_lines)
-        if file1_cksum != file2_cksum:
-            print("-" * 80)
-            print(f"Files {file1} and {file2} differ:")
-            print("-" * 80)
-            diff = difflib.unified_diff(file1_lines, file2_lines, fromfile=file1, tofile=file2)
-            for line in diff:
-                print(line, end='')
-    return
+# Queries context mode of the ASA firewall. Change to system context if ASA
+# has multiple contexts. Returns context mode (single, multiple).
+#
+def get_context_mode(conn, facts=None):
+    return(query_fact(conn, facts, "context-mode"))
 
 
 
 # ----------------------------------------------------------------------------
-# verify_backup
+# get_failover_units
 # ----------------------------------------------------------------------------
-# Startup-config and running-config should be the same. Otherwise a write mem
-# has been forgotten. Config on active and standby unit should also be the
-# same or replication has failed.
-# 
-def verify_backup(destdir, failover_units, contexts):
-    print(f"Verifying backup on {destdir}:")
-    result = subprocess.run(['ls', '-al', destdir], check=True, capture_output=True, text=True)
-    print(result.stdout)
-    compare_files(destdir, "startup-config_active.cfg", "running-config_active.cfg")
-    if "standby" in failover_units:
-        compare_files(destdir, "startup-config_standby.cfg", "running-config_standby.cfg")
-        for context in contexts:
-            compare_files(destdir, f"context_{context}_active.cfg", f"context_{context}_standby.cfg")
-    return
+# Returns list of failover units, active only or active and standby.
+#
+def get_failover_units(conn, facts=None):
+    return(query_fact(conn, facts, "failover-units"))
 
 
 
 # ----------------------------------------------------------------------------
-# backup_firewall
+# get_standby_address
 # ----------------------------------------------------------------------------
-def backup_firewall(cfg, fw):
-    hostname = cfg["firewalls"][fw]["hostname"]
-    if not is_resolvable(hostname):
-        print(f"ERROR: Host {hostname} is not resolvable!")
-        return
-    if not is_host_reachable(hostname):
-        print(f"ERROR: Host {hostname} is not reachable!")
-        return 
+# Returns IP address of standby unit (see parse_standby_address) or None.
+# The address is the one connected to, as resolved by preflight_firewalls.
+#
+def get_standby_address(conn, address, facts=None):
+    if facts and "standby-address" in facts:
+        return(facts["standby-address"])
+    standby_address = parse_standby_address(conn.send_command(FAILOVER_COMMAND), address)
+    if facts is not None and standby_address:
+        facts["standby-address"] = standby_address
+    return(standby_address)
 
-    dt = datetime.now()
-    slot = get_retention_slot(dt)
-    destdir = "/".join([cfg["firewalls"][fw]["backup-dir"], fw, slot])
-    backup_url = "scp://{}:{}@{}/{}".format(
-        cfg["firewalls"][fw]["backup-username"],
-        cfg["firewalls"][fw]["backup-password"],
-        cfg["firewalls"][fw]["backup-host"], destdir
-    )
-    cisco_asa = {
-        "host":                  hostname,
-        "device_type":           "cisco_asa",
-        "username":              cfg["firewalls"][fw]["username"],
-        "password":              cfg["firewalls"][fw]["password"],
-        "secret":                cfg["firewalls"][fw]["enable-secret"],
-        "read_timeout_override": cfg["firewalls"][fw]["read-timeout"],
-        "conn_timeout":          cfg["firewalls"][fw]["conn-timeout"],
-        "session_log":           destdir + "/" + "session.log",
-        "use_keys":              cfg["firewalls"][fw]["use-key"],
-        "key_file":              cfg["firewalls"][fw]["ssh-key"],
-        "disable_sha2_fix":      True,
-        "verbose":               True,
-    }
 
-    print("")
-    print("=" * 80)
-    print("Firewall name   : {}".format(fw))
-    print("Firewall host   : {}".format(hostname))
-    print("Backup host     : {}".format(cfg["firewalls"][fw]["backup-host"]))
-    print("Backup directory: {}".format(destdir))
-    print("Backup date/time: {}".format(dt.strftime("%Y-%m-%d %H:%M:%S")))
-    print("=" * 80)
-    print("")
 
-    try:
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        else:
-            timestamp = dt.timestamp() 
-            os.utime(destdir, (timestamp, timestamp))
-    except Exception as e:
-        sys.exit(f"ERROR: Creating directory {destdir} failed: {e}")
+# ----------------------------------------------------------------------------
+# get_contexts
+# ----------------------------------------------------------------------------
+# Returns list of context names.
+#
+def get_contexts(conn, facts=None):
+    return(query_fact(conn, facts, "contexts"))
+
+
+
+# ----------------------------------------------------------------------------
+# config_url_steps
+# ----------------------------------------------------------------------------
+# Steps (see run_steps) returning the config-url of a context, e. g.
+# disk0:/admin.cfg, or None.
+#
+def config_url_steps(context, facts=None):
+    if facts and context in facts.get("config-urls", {}):
+        return(facts["config-urls"][context])
+    with measure("discover", context=context, step="config-url"):
+        config_url = parse_config_url((yield CONFIG_URL_COMMAND.format(context)))
+    if facts is not None and config_url:
+        facts.setdefault("config-urls", {})[context] = config_url
+    return(config_url)
+
+
+
+# ----------------------------------------------------------------------------
+# get_config_checksum
+# ----------------------------------------------------------------------------
+# Returns the checksum of the configuration of the current context or None.
+#
+def get_config_checksum(conn):
+    output = conn.send_command("show checksum")
+    return(parse_checksum(output))
+
 
+
+# ----------------------------------------------------------------------------
+# parse_checksum
+# ----------------------------------------------------------------------------
+# Parse the output of "show checksum". Example:
+# Cryptochecksum: 3c2ef8fc 2b2e0d5c 1bb4a2ba a4a65c54
+# Returns the checksum as one string or None.
+#
+def parse_checksum(output):
+    pattern = re.compile(r'Cryptochecksum:\s*([0-9a-f]{8}(?:\s+[0-9a-f]{8})*)')
+    if match := pattern.search(output):
+        return("".join(match.group(1).split()))
+    return(None)
+
+
+
+# ----------------------------------------------------------------------------
+# load_facts
+# ----------------------------------------------------------------------------
+# Device facts are the results of the discovery commands (context mode,
+# failover units, version, contexts, config-urls) cached in facts.yaml in
+# the firewall directory. Returns the cached facts if not older than ttl
+# seconds, otherwise an empty dict.
+#
+def load_facts(fwdir, ttl):
+    import yaml
     try:
-        with ConnectHandler(**cisco_asa) as conn:
-            context_mode = get_context_mode(conn)
-            failover_units = get_failover_units(conn)
-            if context_mode == "multiple":
-                ihack = ""
-                conn.send_command("changeto system")
-                contexts = get_contexts(conn)
-            else:
-                ihack = get_interface_hack(conn)
-                contexts = []
-            for unit in failover_units:
-                copy_tech_support(conn, unit, backup_url, ihack)
-                copy_config(conn, unit, backup_url, ihack, contexts)
-                run_backup(conn, unit, backup_url, ihack, contexts, cfg["firewalls"][fw]["password"])
-    except subprocess.CalledProcessError as e:
-        print(f'ERROR: Subprocess call failed: {e}')
+        with open(os.path.join(fwdir, "facts.yaml"), 'r') as file:
+            facts = yaml.safe_load(file) or {}
+    except FileNotFoundError:
+        return({})
     except Exception as e:
-        print(f"ERROR: Backing up {hostname} failed: {e}")
+        log(f"WARNING: Reading facts failed: {e}")
+        return({})
+    if time.time() - facts.get("timestamp", 0) > ttl:
+        return({})
+    return(facts)
 
-    verify_backup(destdir, failover_units, contexts)
-    return
 
 
+# ----------------------------------------------------------------------------
+# check_facts_steps
+# ----------------------------------------------------------------------------
+# The cached facts are only valid as long as the configuration checksum is
+# unchanged. In multiple context mode it is the checksum of the system
+# context, which contains the contexts and their config-urls. Steps (see
+# run_steps) returning the facts if still valid, otherwise an empty dict.
+#
+def check_facts_steps(facts):
+    if not facts:
+        return({})
+    if facts.get("context-mode") == "multiple":
+        yield "changeto system"
+    if parse_checksum((yield "show checksum")) != facts.get("checksum"):
+        log("Configuration changed, discovering device facts again.")
+        return({})
+    log("Using cached device facts.")
+    return(facts)
 
-# -----------------------------------------------------------------------------
-# get_arguments
-# -----------------------------------------------------------------------------
-# Read commandline arguments. Returns a Namespace object with all the given
-# arguments.
+
+
+# ----------------------------------------------------------------------------
+# check_facts
+# ----------------------------------------------------------------------------
+# Returns the cached facts if still valid, see check_facts_steps.
 #
-def get_arguments():
-    parser = argparse.ArgumentParser(
-        description="Update object-groups on the Cisco firewalls.")
-    parser.add_argument('-c', '--config', required=False, 
-        metavar="FILENAME", help="Configuration file in YAML format.")
-    parser.add_argument('-f', '--firewalls', required=True, nargs='+',
-        metavar="NAME", help="""Select firewalls (HA pairs) to be updated as
-        listed in the YAML config file. If not used or set to 'all', all 
-        configured firewalls are backed up.""")
-    args = parser.parse_args()
-    return(args)
+def check_facts(conn, facts):
+    return(run_steps(conn, check_facts_steps(facts)))
 
 
 
 # ----------------------------------------------------------------------------
-# MAIN 
+# save_facts
 # ----------------------------------------------------------------------------
-# Read commandline arguments, configuration file and iterate over the fire-
-# walls given as argument or in configuration file.
+# Store the device facts with the configuration checksum and a timestamp in
+# facts.yaml in the firewall directory. Facts reused from the cache keep the
+# timestamp of their discovery, so they expire after facts-ttl even when
+# the checksum never changes (e. g. after a software upgrade).
 #
-if __name__ == "__main__":
-    write_default_config_file()
-    args = get_arguments()
-    cfg = read_configfile(args.config)    
-    firewalls = validate_firewalls(cfg, args.firewalls)
-    for fw in firewalls:
-        backup_firewall(cfg, fw)
+def save_facts(fwdir, facts):
+    import yaml
+    facts.setdefault("timestamp", int(time.time()))
+    try:
+        file_path = os.path.join(fwdir, "facts.yaml")
+        with open(file_path + ".tmp", 'w') as file:
+            yaml.safe_dump(facts, file, default_flow_style=False)
+        os.replace(file_path + ".tmp", file_path)
+    except Exception as e:
+        log(f"WARNING: Writing facts failed: {e}")
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# get_interface_hack
+# ----------------------------------------------------------------------------
+# Returns the VPN interface hack ";int=inside", see parse_interface_hack.
+#
+def get_interface_hack(conn):
+    return(parse_interface_hack(conn.send_command(INTERFACE_COMMAND)))
+
+
+
+# ----------------------------------------------------------------------------
+# run_batch_commands
+# ----------------------------------------------------------------------------
+# Run array of commands on active ASA (default) or on standby unit. Commands
+# for the standby unit are sent with "failover exec standby", unless direct
+# is set because the session is connected to the standby unit itself.
+#
+def run_batch_commands(conn, commands, unit="active", direct=False):
+    for command in commands:
+        with measure(**command_labels(command, unit)) as record:
+            output = conn.send_command(unit_command(command, unit, direct))
+            #log(output)
+            record_copy(record, output)
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# run_steps
+# ----------------------------------------------------------------------------
+# The command sequences shared by the Netmiko and the asyncio engine are
+# generators of steps (the functions named *_steps). A step is either a
+# command, the generator receives its output, or a tuple of commands, unit
+# and direct to run as a batch (see run_batch_commands). Run the steps on a
+# Netmiko connection, see run_steps_async for the asyncio engine. Returns
+# the return value of the generator.
+#
+def run_steps(conn, steps):
+    output = None
+    try:
+        while True:
+            step = steps.send(output)
+            if isinstance(step, str):
+                output = conn.send_command(step)
+            else:
+                output = run_batch_commands(conn, *step)
+    except StopIteration as e:
+        return(e.value)
+
+
+
+# ----------------------------------------------------------------------------
+# record_copy
+# ----------------------------------------------------------------------------
+# Set the bytes of a measure record of a copy command to the size of the
+# copied file in the backup directory of the current job and add the file
+# to the journal (see add_journal). The size the firewall reports in the
+# output ("... bytes copied") is kept as expected, see process_artifact.
+# Slot directories are reused, so the file may be left over from an older
+# backup. It is only journaled if the copy succeeded, the size matches and
+# the file was written after the job started (see copied_in_job).
+#
+def record_copy(record, output=""):
+    report = REPORT.get()
+    if report is None or record["step"] != "copy":
+        return
+    if match := re.search(r'^(\d+) bytes copied', output or "", re.M):
+        record["expected"] = int(match.group(1))
+    file_path = os.path.join(report["destdir"], record["file"])
+    if not copied_in_job(file_path):
+        return
+    record["bytes"] = os.path.getsize(file_path)
+    if match and record["bytes"] == record["expected"]:
+        add_journal(record["unit"], record["context"], record["file"])
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# copied_in_job
+# ----------------------------------------------------------------------------
+# Returns True if the file exists and was written after the current job
+# started (see open_journal), i. e. it is not a leftover of the backup in
+# the same slot a week ago. Timestamps are compared in whole seconds, some
+# filesystems store no fractions.
+#
+def copied_in_job(file_path):
+    journal = JOURNAL.get()
+    try:
+        mtime = os.path.getmtime(file_path)
+    except OSError:
+        return(False)
+    return(journal is None or int(mtime) >= int(journal["start"]))
+
+
+
+# ----------------------------------------------------------------------------
+# open_journal
+# ----------------------------------------------------------------------------
+# The journal journal.jsonl in the slot directory records every file of the
+# backup as soon as it is completed (unit, context, file, size, sha256), one
+# JSON object per line after a start line with the date. A complete backup
+# ends with a complete line. With resume the journal of an incomplete backup
+# of the same day is continued: files listed with unchanged size and hash
+# are done and not collected again (see is_done). Otherwise a new journal
+# is started. Returns the journal as dict with path, done files and the
+# start time of the job.
+#
+JOURNAL = contextvars.ContextVar("journal", default=None)
+
+def open_journal(destdir, dt, resume=False):
+    journal = {
+        "path": os.path.join(destdir, "journal.jsonl"),
+        "done": {},
+        "lock": threading.Lock(),
+        "start": dt.timestamp(),
+    }
+    entries = []
+    if resume:
+        try:
+            with open(journal["path"], 'r') as file:
+                entries = [ json.loads(line) for line in file if line.strip() ]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log(f"WARNING: Reading journal failed: {e}")
+    date = dt.strftime("%Y-%m-%d")
+    if (entries and entries[0].get("event") == "start" and entries[0]["date"][:10] == date
+            and not any(e.get("event") == "complete" for e in entries)):
+        for entry in entries:
+            if "file" not in entry:
+                continue
+            file_path = os.path.join(destdir, entry["file"])
+            if (os.path.isfile(file_path) and os.path.getsize(file_path) == entry["size"]
+                    and hash_file(file_path) == entry["sha256"]):
+                journal["done"][entry["file"]] = entry
+        log(f"Resuming backup, {len(journal['done'])} files already done.")
+    else:
+        with open(journal["path"], 'w') as file:
+            file.write(json.dumps({ "event": "start", "date": dt.strftime("%Y-%m-%d %H:%M:%S") }) + "\n")
+    return(journal)
+
+
+
+# ----------------------------------------------------------------------------
+# add_journal
+# ----------------------------------------------------------------------------
+# Add a completed file of the slot directory to the journal of the current
+# job. Ignored if there is no journal.
+#
+def add_journal(unit, context, file):
+    journal = JOURNAL.get()
+    if journal is None:
+        return
+    file_path = os.path.join(os.path.dirname(journal["path"]), file)
+    entry = {
+        "unit":    unit,
+        "context": context,
+        "file":    file,
+        "size":    os.path.getsize(file_path),
+        "sha256":  hash_file(file_path),
+        "date":    datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    with journal["lock"]:
+        with open(journal["path"], 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+        journal["done"][file] = entry
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# close_journal
+# ----------------------------------------------------------------------------
+# Mark the backup in the journal as complete, so it is not resumed.
+#
+def close_journal(journal):
+    with journal["lock"]:
+        with open(journal["path"], 'a') as file:
+            file.write(json.dumps({ "event": "complete",
+                                    "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S") }) + "\n")
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# is_done
+# ----------------------------------------------------------------------------
+# Returns True if the file has been completed by the resumed backup (see
+# open_journal) and logs that it is skipped.
+#
+def is_done(file):
+    journal = JOURNAL.get()
+    if journal is None or file not in journal["done"]:
+        return(False)
+    log(f"Skipping {file}, already done.")
+    return(True)
+
+
+
+# ----------------------------------------------------------------------------
+# unit_command
+# ----------------------------------------------------------------------------
+# Returns the command to run on the given unit. Commands for the standby
+# unit are prefixed with "failover exec standby" unless direct is set.
+#
+def unit_command(command, unit="active", direct=False):
+    if unit == "standby" and not direct:
+        command = f"failover exec {unit} {command}"
+    return(command)
+
+
+
+# ----------------------------------------------------------------------------
+# get_checksums
+# ----------------------------------------------------------------------------
+# Query the configuration checksum of the unit with "show checksum". In
+# multiple context mode the checksum of the system and of every context is
+# queried, otherwise the checksum of the single context. Returns dict with
+# context name ("single", "system" or context) as key and checksum as value.
+#
+def get_checksums(conn, unit, contexts, direct=False):
+    checksums = {}
+    if not contexts:
+        names = [ "single" ]
+    else:
+        names = [ "system" ] + contexts
+    try:
+        for name in names:
+            if name not in ("single", "system"):
+                conn.send_command(unit_command(f"changeto context {name}", unit, direct))
+            output = conn.send_command(unit_command("show checksum", unit, direct))
+            if checksum := parse_checksum(output):
+                checksums[name] = checksum
+    finally:
+        if contexts:
+            conn.send_command(unit_command("changeto system", unit, direct))
+    return(checksums)
+
+
+
+# ----------------------------------------------------------------------------
+# get_context_files
+# ----------------------------------------------------------------------------
+# Returns list of the files collected for a context ("single", "system" or
+# context name) on a unit, which can be skipped if the context is unchanged.
+#
+def get_context_files(context, unit):
+    if context == "single":
+        files = [ f"backup_{unit}.tar.gz" ]
+    elif context == "system":
+        files = [ f"backup_system_{unit}.tar.gz" ]
+    else:
+        files = [ f"context_{context}_{unit}.cfg", f"backup_{context}_{unit}.tar.gz" ]
+    return(files)
+
+
+
+# ----------------------------------------------------------------------------
+# read_checksums
+# ----------------------------------------------------------------------------
+# Read the checksums of the last successful backup from checksums.yaml in the
+# firewall directory. Returns dict unit -> context -> {checksum, slot}.
+#
+def read_checksums(fwdir):
+    import yaml
+    try:
+        with open(os.path.join(fwdir, "checksums.yaml"), 'r') as file:
+            return(yaml.safe_load(file) or {})
+    except FileNotFoundError:
+        return({})
+    except Exception as e:
+        log(f"WARNING: Reading checksums failed: {e}")
+        return({})
+
+
+
+# ----------------------------------------------------------------------------
+# write_checksums
+# ----------------------------------------------------------------------------
+# Store the checksums of this backup in checksums.yaml in the firewall
+# directory, with the slot holding the files. Only contexts that were
+# hardlinked as unchanged (skipped, see prepare_incremental) or whose files
+# are all in the journal of this backup are stored. The slot is reused and
+# may still hold the files of a week ago after a failed copy, these and
+# other incomplete contexts are fully backed up next time.
+#
+def write_checksums(fwdir, slot, checksums, skipped, journal):
+    import yaml
+    store = {}
+    for unit in checksums:
+        store[unit] = {}
+        for context, checksum in checksums[unit].items():
+            files = get_context_files(context, unit)
+            if context in skipped.get(unit, ()) or all(f in journal["done"] for f in files):
+                store[unit][context] = { "checksum": checksum, "slot": slot }
+    try:
+        file_path = os.path.join(fwdir, "checksums.yaml")
+        with open(file_path + ".tmp", 'w') as file:
+            yaml.safe_dump(store, file, default_flow_style=False)
+        os.replace(file_path + ".tmp", file_path)
+    except Exception as e:
+        log(f"WARNING: Writing checksums failed: {e}")
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# prepare_incremental
+# ----------------------------------------------------------------------------
+# Compare the current checksums of all units and contexts with the ones of
+# the last backup. Files of unchanged contexts are hardlinked from the slot
+# of the last backup (or the object store) into destdir, so they need not be
+# collected again.
+# Other hardlinked files in destdir are removed first, because scp would
+# overwrite the shared file in the other slots too.
+# Returns tuple of dict unit -> set of skipped contexts and dict of current
+# checksums (see get_checksums) per unit.
+#
+def prepare_incremental(conn, fwdir, destdir, failover_units, contexts):
+    store = read_checksums(fwdir)
+    checksums = {}
+    skip = {}
+    links = []
+    for unit in failover_units:
+        checksums[unit] = get_checksums(conn, unit, contexts)
+        skip[unit] = set()
+        for context, checksum in checksums[unit].items():
+            last = store.get(unit, {}).get(context)
+            if not last or last["checksum"] != checksum:
+                continue
+            files = get_context_files(context, unit)
+            sources = [ find_slot_file(fwdir, last["slot"], f) for f in files ]
+            if all(sources):
+                skip[unit].add(context)
+                links += list(zip(sources, files))
+    keep = { f for src, f in links if src == os.path.join(destdir, f) }
+    for entry in os.scandir(destdir):
+        if entry.is_file() and entry.stat().st_nlink > 1 and entry.name not in keep:
+            os.unlink(entry.path)
+    for src, f in links:
+        if f in keep:
+            continue
+        dst = os.path.join(destdir, f)
+        if os.path.exists(dst):
+            os.unlink(dst)
+        os.link(src, dst)
+    for unit in failover_units:
+        for context in sorted(skip[unit]):
+            log(f"Context {context} on {unit} unit unchanged, skipping backup.")
+    return(skip, checksums)
+
+
+
+# ----------------------------------------------------------------------------
+# tech_support_commands
+# ----------------------------------------------------------------------------
+# Sending tech-support directly to scp path fails. Copy first to flash disk,
+# then copy, then delete. Returns list of commands.
+#
+def tech_support_commands(unit, backup_url, ihack):
+    file = f"tech-support_{unit}.txt"
+    commands = [
+        f"show tech-support file flash:/{file}",
+        f"copy /noconfirm flash:/{file} {backup_url}/{file}{ihack}",
+        f"delete /noconfirm flash:/{file}"
+    ]
+    return(commands)
+
+
+
+# ----------------------------------------------------------------------------
+# config_commands
+# ----------------------------------------------------------------------------
+# Returns list of commands copying running-config, startup-config and the
+# context configs given as list of (context, config-url) tuples.
+#
+def config_commands(unit, backup_url, ihack, config_urls):
+    commands = [
+      f"copy /noconfirm running-config {backup_url}/running-config_{unit}.cfg{ihack}",
+      f"copy /noconfirm startup-config {backup_url}/startup-config_{unit}.cfg{ihack}"
+    ]
+    for context, srcfile in config_urls:
+        commands.append(f"copy /noconfirm {srcfile} {backup_url}/context_{context}_{unit}.cfg{ihack}")
+    return(commands)
+
+
+
+# ----------------------------------------------------------------------------
+# backup_commands
+# ----------------------------------------------------------------------------
+# Returns tuple of archive filename and list of the backup, copy and delete
+# command for a context, or in single context mode if context is None.
+#
+def backup_commands(context, unit, backup_url, ihack, passphrase):
+    if context is None:
+        file = f"backup_{unit}.tar.gz"
+        backup = f"backup /noconfirm passphrase {passphrase} location flash:/{file}"
+    else:
+        file = f"backup_{context}_{unit}.tar.gz"
+        backup = f"backup /noconfirm context {context} passphrase {passphrase} location flash:/{file}"
+    commands = [
+        backup,
+        f"copy /noconfirm flash:/{file} {backup_url}/{file}{ihack}",
+        f"delete /noconfirm flash:/{file}"
+    ]
+    return(file, commands)
+
+
+
+# ----------------------------------------------------------------------------
+# supports_backup
+# ----------------------------------------------------------------------------
+# The backup command was added with ASA version 9.3(2). Returns True if the
+# version (see parse_version) has it.
+#
+def supports_backup(ver):
+    return(ver["major"] >= 9 and ver["minor"] >= 3 and ver["maintenance"] >= 2)
+
+
+
+# ----------------------------------------------------------------------------
+# copy_tech_support_steps
+# ----------------------------------------------------------------------------
+# Steps (see run_steps) collecting tech-support of a unit, see
+# tech_support_commands.
+#
+def copy_tech_support_steps(unit, backup_url, ihack, direct=False):
+    if is_done(f"tech-support_{unit}.txt"):
+        return
+    log(f"Collecting tech-support on {unit} unit  ...")
+    yield (tech_support_commands(unit, backup_url, ihack), unit, direct)
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# copy_tech_support
+# ----------------------------------------------------------------------------
+# Collect tech-support of a unit, see copy_tech_support_steps.
+#
+def copy_tech_support(conn, unit, backup_url, ihack, direct=False):
+    run_steps(conn, copy_tech_support_steps(unit, backup_url, ihack, direct))
+    return 
+
+
+
+# ----------------------------------------------------------------------------
+# write_stream
+# ----------------------------------------------------------------------------
+# Write a chunk of command output read from the SSH channel to file. Only
+# complete lines are written, the incomplete last line is kept as pending
+# (at most STREAM_BUFFER characters) until it is either continued or turns
+# out to be the prompt. Pending None means the echo of the command has not
+# been skipped yet. Returns tuple (pending, done), done when the prompt has
+# been read.
+#
+STREAM_BUFFER = 65536
+
+def write_stream(file, pending, chunk, prompt):
+    chunk = chunk.replace('\r', '')
+    if pending is None:
+        if '\n' not in chunk:
+            return(None, False)
+        chunk = chunk.split('\n', 1)[1]
+        pending = ""
+    lines, newline, pending = (pending + chunk).rpartition('\n')
+    file.write(lines + newline)
+    if prompt.match(pending):
+        return(pending, True)
+    if len(pending) > STREAM_BUFFER:
+        file.write(pending)
+        pending = ""
+    return(pending, False)
+
+
+
+# ----------------------------------------------------------------------------
+# stream_tech_support
+# ----------------------------------------------------------------------------
+# Capture "show tech-support" of a unit directly from the SSH channel into
+# tech-support_<unit>.txt.gz in destdir, instead of writing it to flash and
+# copying it with scp (see copy_tech_support). The channel is read in chunks
+# and compressed while streaming. The output bypasses the session log.
+#
+def stream_tech_support(conn, unit, destdir, direct=False):
+    if is_done(f"tech-support_{unit}.txt.gz"):
+        return
+    log(f"Streaming tech-support of {unit} unit ...")
+    file_path = os.path.join(destdir, f"tech-support_{unit}.txt.gz")
+    prompt = re.compile(re.escape(conn.base_prompt) + r'\S*[#>] ?$')
+    channel = conn.remote_conn
+    timeout = channel.gettimeout()
+    deadline = time.monotonic() + (conn.read_timeout_override or 1800)
+    pending = None
+    with measure("tech-support", unit=unit, step="stream", file=os.path.basename(file_path)) as record:
+        try:
+            channel.settimeout(1)
+            conn.write_channel(unit_command("show tech-support", unit, direct) + conn.RETURN)
+            with gzip.open(file_path, 'wt', encoding="utf-8") as file:
+                done = False
+                while not done:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError("Timeout reading tech-support.")
+                    try:
+                        chunk = channel.recv(STREAM_BUFFER)
+                    except socket.timeout:
+                        continue
+                    if not chunk:
+                        raise ConnectionError("SSH session closed by firewall.")
+                    record["bytes"] += len(chunk)
+                    pending, done = write_stream(file, pending, chunk.decode(errors="replace"), prompt)
+        finally:
+            channel.settimeout(timeout)
+    log(f"Streamed {record['bytes']} bytes to {os.path.basename(file_path)} ({os.path.getsize(file_path)} bytes compressed).")
+    add_journal(unit, None, os.path.basename(file_path))
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# copy_config_steps
+# ----------------------------------------------------------------------------
+# Steps (see run_steps) copying running-config and startup-config to
+# backup_url. In single mode it is the entire configuration in multiple
+# context mode it is only the system context. Contexts in skip are
+# unchanged and not copied again.
+#
+def copy_config_steps(unit, backup_url, ihack, contexts, direct=False, skip=(),
+                      facts=None):
+    log(f"Collecting config on {unit} unit ...")
+    # We have contexts. Also backup the context configs individually.
+    config_urls = []
+    for context in contexts:
+        if context in skip:
+            continue
+        if srcfile := (yield from config_url_steps(context, facts)):
+            config_urls.append((context, srcfile))
+    commands = [ c for c in config_commands(unit, backup_url, ihack, config_urls)
+                 if not is_done(command_labels(c, unit)["file"]) ]
+    yield (commands, unit, direct)
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# copy_config
+# ----------------------------------------------------------------------------
+# Copy the configs of a unit, see copy_config_steps.
+#
+def copy_config(conn, unit, backup_url, ihack, contexts, direct=False, skip=(),
+                facts=None):
+    run_steps(conn, copy_config_steps(unit, backup_url, ihack, contexts, direct, skip, facts))
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# run_backup_steps
+# ----------------------------------------------------------------------------
+# The backup command was added with ASA version 9.3(2).
+# It contains the running-config, startup-config, certificates and if there
+# was no bug with multiple contexts, also webvpn data such as anyconnect
+# packages, but backup of WebVPN data fails in multiple contexts.
+# First run a backup to flash disk and then copy it via scp due to Cisco bug
+# CSCvh02142. Steps (see run_steps) with one batch per archive, see
+# backup_commands. Contexts in skip are unchanged and not backed up again,
+# nor are archives done in a resumed backup.
+#
+def run_backup_steps(unit, backup_url, ihack, contexts, passphrase, direct=False,
+                     skip=(), facts=None):
+    if not supports_backup((yield from query_fact_steps(facts, "version"))):
+        log("Backup command not invented yet.")
+        return
+    if not contexts:
+        if "single" in skip or is_done(f"backup_{unit}.tar.gz"):
+            return
+        log(f"Backing up single context on {unit} unit ...")
+        file, commands = backup_commands(None, unit, backup_url, ihack, passphrase)
+        yield (commands, unit, direct)
+        return
+    # We have contexts. Also backup system context.
+    for context in [ "system" ] + contexts:
+        if context in skip or is_done(f"backup_{context}_{unit}.tar.gz"):
+            continue
+        log(f"Backing up context {context} on {unit} unit ...")
+        file, commands = backup_commands(context, unit, backup_url, ihack, passphrase)
+        yield (commands, unit, direct)
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# run_backup
+# ----------------------------------------------------------------------------
+# Backup a unit, see run_backup_steps. With a second session copy_conn the
+# contexts are backed up in a pipeline, see run_backup_pipelined.
+#
+def run_backup(conn, unit, backup_url, ihack, contexts, passphrase, direct=False,
+               copy_conn=None, depth=0, skip=(), facts=None):
+    steps = run_backup_steps(unit, backup_url, ihack, contexts, passphrase, direct,
+                             skip, facts)
+    if copy_conn and depth > 0 and contexts:
+        run_backup_pipelined(conn, copy_conn, steps, depth)
+    else:
+        run_steps(conn, steps)
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# run_backup_pipelined
+# ----------------------------------------------------------------------------
+# Run the steps of run_backup_steps in a pipeline with two sessions. The
+# session conn keeps writing backup archives of the contexts to flash, while
+# a worker thread copies the finished archives with session copy_conn to the
+# backup server and deletes them on flash. At most depth archives are on
+# flash at a time.
+#
+def run_backup_pipelined(conn, copy_conn, steps, depth):
+    in_flight = threading.Semaphore(depth)
+    archives = queue.Queue()
+    errors = []
+
+    def copy_archives():
+        while (archive := archives.get()) is not None:
+            copy, delete, unit, direct = archive
+            file = command_labels(copy, unit)["file"]
+            try:
+                if not errors:
+                    log(f"Copying {file} from {unit} unit ...")
+                    run_batch_commands(copy_conn, [ copy ], unit, direct)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                try:
+                    run_batch_commands(copy_conn, [ delete ], unit, direct)
+                except Exception as e:
+                    errors.append(e)
+                in_flight.release()
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        copier = pool.submit(contextvars.copy_context().run, copy_archives)
+        try:
+            output = None
+            while True:
+                step = steps.send(output)
+                if isinstance(step, str):
+                    output = conn.send_command(step)
+                    continue
+                (backup, copy, delete), unit, direct = step
+                output = None
+                in_flight.acquire()
+                if errors:
+                    in_flight.release()
+                    break
+                try:
+                    run_batch_commands(conn, [ backup ], unit, direct)
+                except Exception:
+                    in_flight.release()
+                    raise
+                archives.put((copy, delete, unit, direct))
+        except StopIteration:
+            pass
+        finally:
+            archives.put(None)
+            copier.result()
+    if errors:
+        raise errors[0]
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# collect_unit
+# ----------------------------------------------------------------------------
+# Collect tech-support, configs and backups of one failover unit. The
+# optional second session copy_conn is used to pipeline context backups.
+# Unchanged contexts in skip are not collected. Device facts are taken from
+# and stored in facts.
+#
+def collect_unit(conn, unit, backup_url, ihack, contexts, passphrase, direct=False,
+                 copy_conn=None, depth=0, skip=(), facts=None, stream_dir=None):
+    if stream_dir:
+        stream_tech_support(conn, unit, stream_dir, direct)
+    else:
+        copy_tech_support(conn, unit, backup_url, ihack, direct)
+    copy_config(conn, unit, backup_url, ihack, contexts, direct, skip, facts)
+    run_backup(conn, unit, backup_url, ihack, contexts, passphrase, direct,
+               copy_conn, depth, skip, facts)
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# ManagedConnection
+# ----------------------------------------------------------------------------
+# Netmiko connection that survives brief outages. Takes the ConnectHandler
+# parameters plus "retries" and "retry_delay". A command that fails is sent
+# again up to retries times on a new connection, waiting retry_delay seconds
+# and doubling the delay each time. After a reconnect the last changeto
+# command is repeated, so the command runs in the same context. So is the
+# last "failover exec <unit> changeto" per unit, the context of commands
+# sent to the peer unit is also lost with the session. All commands of the
+# script overwrite or delete fixed file names and are safe to repeat. Other
+# attributes are passed through to the Netmiko connection.
+#
+CHANGETO_PATTERN = re.compile(r'(failover exec \S+ )?changeto ')
+
+class ManagedConnection:
+
+    def __init__(self, params):
+        self.params = dict(params)
+        self.retries = self.params.pop("retries", 0)
+        self.retry_delay = self.params.pop("retry_delay", 5)
+        self.changeto = {}
+        self.conn = None
+        self.retry(self.connect)
+
+    def __getattr__(self, name):
+        return(getattr(self.conn, name))
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *args):
+        self.disconnect()
+        return(False)
+
+    def connect(self):
+        if self.conn is None:
+            from netmiko import ConnectHandler
+            self.conn = ConnectHandler(**self.params)
+            log(f"SSH connection established to {self.params['host']}:{self.params['port']}.")
+            self.params["session_log_file_mode"] = "append"
+            for command in self.changeto.values():
+                self.conn.send_command(command)
+        return
+
+    def disconnect(self):
+        if self.conn is not None:
+            try:
+                self.conn.disconnect()
+            except Exception:
+                pass
+            self.conn = None
+        return
+
+    def retry(self, function):
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                return(function())
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                log(f"WARNING: Connection to {self.params['host']} failed: {e}")
+                log(f"Reconnecting in {delay} seconds (attempt {attempt + 1} of {self.retries}) ...")
+                self.disconnect()
+                time.sleep(delay)
+                delay *= 2
+
+    def send_command(self, command, *args, **kwargs):
+        def send():
+            self.connect()
+            return(self.conn.send_command(command, *args, **kwargs))
+        output = self.retry(send)
+        if match := CHANGETO_PATTERN.match(command):
+            self.changeto[match.group(1) or ""] = command
+        return(output)
+
+
+
+# ----------------------------------------------------------------------------
+# open_session
+# ----------------------------------------------------------------------------
+# Open an additional SSH session to a firewall unit with its own session log
+# session_<name>.log. Changes to system context in multiple context mode.
+# Returns the connection or None if the session could not be opened.
+#
+def open_session(cisco_asa, name, context_mode, host=None):
+    params = dict(cisco_asa)
+    params["host"] = host or cisco_asa["host"]
+    params["session_log"] = re.sub(r'session\.log$', f'session_{name}.log', cisco_asa["session_log"])
+    try:
+        with measure("connect", step=name):
+            conn = ManagedConnection(params)
+        if context_mode == "multiple":
+            conn.send_command("changeto system")
+    except Exception as e:
+        log(f"WARNING: Opening {name} session to {params['host']} failed: {e}")
+        return(None)
+    return(conn)
+
+
+
+# ----------------------------------------------------------------------------
+# close_session
+# ----------------------------------------------------------------------------
+# Close a session opened with open_session. Ignores sessions not opened.
+#
+def close_session(conn):
+    if conn:
+        try:
+            conn.disconnect()
+        except Exception:
+            pass
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# collect_standby
+# ----------------------------------------------------------------------------
+# Open a separate SSH session to the standby unit and collect its backups
+# directly, without "failover exec standby". Runs in its own thread while
+# the active unit is collected over the main session. Returns False if the
+# session could not be opened, so the caller can fall back to failover exec.
+#
+def collect_standby(cisco_asa, standby_host, context_mode, backup_url, contexts, passphrase,
+                    depth=0, skip=(), facts=None, stream_dir=None):
+    conn = open_session(cisco_asa, "standby", context_mode, standby_host)
+    if not conn:
+        return(False)
+    copy_conn = None
+    try:
+        log(f"Connected to standby unit {standby_host}.")
+        if context_mode == "multiple":
+            ihack = ""
+            if depth > 0:
+                copy_conn = open_session(cisco_asa, "standby_copy", context_mode, standby_host)
+        else:
+            ihack = get_interface_hack(conn)
+        collect_unit(conn, "standby", backup_url, ihack, contexts, passphrase, True,
+                     copy_conn, depth, skip, facts, stream_dir)
+    finally:
+        close_session(copy_conn)
+        close_session(conn)
+    return(True)
+
+
+
+# ----------------------------------------------------------------------------
+# find_cryptochecksum 
+# ----------------------------------------------------------------------------
+def find_cryptochecksum(lines):
+    pattern = re.compile(r'^Cryptochecksum:([0-9a-f]+)$')
+    checksum = False
+    for line in lines:
+        if match := pattern.match(line.strip()):
+            checksum = match.group(1)
+    return(checksum)
+
+
+
+# ----------------------------------------------------------------------------
+# scan_config
+# ----------------------------------------------------------------------------
+# Read a config file line by line without keeping it in memory. Returns dict
+# with SHA-256 hash, Cryptochecksum (False if none), size and line count.
+#
+def scan_config(file_path):
+    digest = hashlib.sha256()
+    checksum_lines = []
+    lines = 0
+    with open(file_path, 'rb') as file:
+        for line in file:
+            digest.update(line)
+            lines += 1
+            if line.startswith(b"Cryptochecksum:"):
+                checksum_lines.append(line.decode('utf-8', 'replace'))
+    result = {
+        "sha256":   digest.hexdigest(),
+        "checksum": find_cryptochecksum(checksum_lines),
+        "size":     os.path.getsize(file_path),
+        "lines":    lines,
+    }
+    return(result)
+
+
+
+# ----------------------------------------------------------------------------
+# index_stanzas
+# ----------------------------------------------------------------------------
+# Split a config file into top-level stanzas: a line starting in column one
+# with all following indented lines. Only a hash, the byte offset, the first
+# line number and the line count of each stanza are kept, so the lines can
+# be read again for the diff. Returns list of tuples.
+#
+def index_stanzas(file_path):
+    stanzas = []
+    digest = None
+    offset = start = first = count = 0
+    with open(file_path, 'rb') as file:
+        for number, line in enumerate(file, 1):
+            if not line[:1].isspace() or digest is None:
+                if digest is not None:
+                    stanzas.append((digest.digest(), start, first, count))
+                digest = hashlib.blake2b(digest_size=16)
+                start, first, count = offset, number, 0
+            digest.update(line.rstrip(b"\r\n"))
+            digest.update(b"\n")
+            offset += len(line)
+            count += 1
+    if digest is not None:
+        stanzas.append((digest.digest(), start, first, count))
+    return(stanzas)
+
+
+
+# ----------------------------------------------------------------------------
+# patience_matches
+# ----------------------------------------------------------------------------
+# Patience diff of two sequences of hashes. Common prefix and suffix match,
+# in between the elements occurring exactly once in both sequences are the
+# anchors. The longest increasing run of anchors is matched and the gaps
+# between them are diffed recursively. Returns sorted list of matching
+# index pairs.
+#
+def patience_matches(a, b, alo=0, ahi=None, blo=0, bhi=None):
+    ahi = len(a) if ahi is None else ahi
+    bhi = len(b) if bhi is None else bhi
+    matches = []
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        matches.append((alo, blo))
+        alo += 1
+        blo += 1
+    tail = []
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+        tail.append((ahi, bhi))
+    if alo < ahi and blo < bhi:
+        count_a = {}
+        for i in range(alo, ahi):
+            count_a[a[i]] = count_a.get(a[i], 0) + 1
+        pos_b = {}
+        for j in range(blo, bhi):
+            pos_b[b[j]] = -1 if b[j] in pos_b else j
+        anchors = [ (i, pos_b[a[i]]) for i in range(alo, ahi)
+                    if count_a[a[i]] == 1 and pos_b.get(a[i], -1) >= 0 ]
+        # Longest increasing subsequence of anchors by patience sorting.
+        tops = []
+        tops_index = []
+        previous = [ None ] * len(anchors)
+        for k, (i, j) in enumerate(anchors):
+            pile = bisect.bisect_left(tops, j)
+            if pile == len(tops):
+                tops.append(j)
+                tops_index.append(k)
+            else:
+                tops[pile] = j
+                tops_index[pile] = k
+            previous[k] = tops_index[pile - 1] if pile > 0 else None
+        lis = []
+        k = tops_index[-1] if tops_index else None
+        while k is not None:
+            lis.append(anchors[k])
+            k = previous[k]
+        lis.reverse()
+        for i, j in lis:
+            matches += patience_matches(a, b, alo, i, blo, j)
+            matches.append((i, j))
+            alo, blo = i + 1, j + 1
+        if lis:
+            matches += patience_matches(a, b, alo, ahi, blo, bhi)
+    matches += reversed(tail)
+    return(matches)
+
+
+
+# ----------------------------------------------------------------------------
+# read_lines
+# ----------------------------------------------------------------------------
+# Read count lines of a file starting at byte offset. Returns list of str.
+#
+def read_lines(file, offset, count):
+    file.seek(offset)
+    return([ file.readline().decode('utf-8', 'replace') for _ in range(count) ])
+
+
+
+# ----------------------------------------------------------------------------
+# first_line
+# ----------------------------------------------------------------------------
+# Returns the line number of stanza i, or the line after the last stanza.
+#
+def first_line(stanzas, i):
+    if i < len(stanzas):
+        return(stanzas[i][2])
+    if stanzas:
+        return(stanzas[-1][2] + stanzas[-1][3])
+    return(1)
+
+
+
+# ----------------------------------------------------------------------------
+# hunk_range
+# ----------------------------------------------------------------------------
+# Returns the range of a unified diff hunk header. Like difflib, an empty
+# range starts at the line before.
+#
+def hunk_range(start, length):
+    if length == 0:
+        start -= 1
+    return(f"{start},{length}")
+
+
+
+# ----------------------------------------------------------------------------
+# diff_configs
+# ----------------------------------------------------------------------------
+# Diff two config files stanza by stanza. The stanzas are matched with a
+# patience diff on their hashes, only the lines of unmatched stanzas are
+# read again and diffed line by line. Returns list of unified diff lines,
+# at most max_lines.
+#
+def diff_configs(path1, path2, file1, file2, max_lines=DIFF_MAX_LINES):
+    stanzas1 = index_stanzas(path1)
+    stanzas2 = index_stanzas(path2)
+    matches = patience_matches([ s[0] for s in stanzas1 ], [ s[0] for s in stanzas2 ])
+    output = [ f"--- {file1}", f"+++ {file2}" ]
+    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+        i = j = 0
+        for mi, mj in matches + [ (len(stanzas1), len(stanzas2)) ]:
+            if i < mi or j < mj:
+                lines1, lines2 = [], []
+                line1 = first_line(stanzas1, i)
+                line2 = first_line(stanzas2, j)
+                for _, offset, _, count in stanzas1[i:mi]:
+                    lines1 += read_lines(f1, offset, count)
+                for _, offset, _, count in stanzas2[j:mj]:
+                    lines2 += read_lines(f2, offset, count)
+                matcher = difflib.SequenceMatcher(None, lines1, lines2, autojunk=False)
+                for group in matcher.get_grouped_opcodes(3):
+                    a0, a1 = group[0][1], group[-1][2]
+                    b0, b1 = group[0][3], group[-1][4]
+                    output.append(f"@@ -{hunk_range(line1 + a0, a1 - a0)} +{hunk_range(line2 + b0, b1 - b0)} @@")
+                    for tag, x0, x1, y0, y1 in group:
+                        if tag == "equal":
+                            output += [ " " + l.rstrip('\r\n') for l in lines1[x0:x1] ]
+                            continue
+                        output += [ "-" + l.rstrip('\r\n') for l in lines1[x0:x1] ]
+                        output += [ "+" + l.rstrip('\r\n') for l in lines2[y0:y1] ]
+                if len(output) > max_lines:
+                    break
+            i, j = mi + 1, mj + 1
+    if len(output) > max_lines:
+        output = output[:max_lines]
+        output.append(f"... diff truncated after {max_lines} lines.")
+    return(output)
+
+
+
+# ----------------------------------------------------------------------------
+# ConfigNode
+# ----------------------------------------------------------------------------
+# Node of a parsed config: a line and the nodes of the more indented lines
+# below it. Slots keep the nodes small, a config has one node per line.
+#
+class ConfigNode:
+    __slots__ = ("line", "children")
+
+    def __init__(self, line):
+        self.line = line
+        self.children = []
+
+    def members(self, indent=" "):
+        for child in self.children:
+            yield(indent + child.line)
+            yield from child.members(indent + " ")
+
+
+
+# ----------------------------------------------------------------------------
+# parse_config
+# ----------------------------------------------------------------------------
+# Parse a config file into a tree of ConfigNode by indentation. Returns the
+# root node, its children are the top-level lines. Comments (!, :) and the
+# Cryptochecksum are left out.
+#
+def parse_config(file_path):
+    root = ConfigNode(None)
+    stack = [ (-1, root) ]
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as file:
+        for line in file:
+            line = line.rstrip()
+            text = line.lstrip()
+            if not text or text.startswith(("!", ":", "Cryptochecksum:")):
+                continue
+            indent = len(line) - len(text)
+            while stack[-1][0] >= indent:
+                stack.pop()
+            node = ConfigNode(text)
+            stack[-1][1].children.append(node)
+            stack.append((indent, node))
+    return(root)
+
+
+
+# ----------------------------------------------------------------------------
+# config_blocks
+# ----------------------------------------------------------------------------
+# Group the top-level nodes of a parsed config into blocks that are compared
+# as a whole. Returns dict of block name -> (ordered list, unordered set).
+# The entries of an access-list and the nat rules keep their order, remarks
+# of access-lists and the lines of all other blocks (members of
+# object-groups, interface settings, entries of a crypto map) do not. One-line
+# commands without children are blocks of their own.
+#
+def config_blocks(root):
+    blocks = {}
+    for node in root.children:
+        words = node.line.split()
+        ordered = None
+        if words[0] == "access-list" and len(words) > 2:
+            name = " ".join(words[:2])
+            if words[2] != "remark":
+                ordered = node.line
+        elif words[0] == "nat":
+            name = "nat"
+            ordered = node.line
+        elif words[:2] == [ "crypto", "map" ] and len(words) > 3:
+            name = " ".join(words[:4])
+        else:
+            name = node.line
+        block = blocks.setdefault(name, ([], set()))
+        if ordered:
+            block[0].append(ordered)
+        else:
+            block[1].add(node.line)
+        block[1].update(node.members())
+    return(blocks)
+
+
+
+# ----------------------------------------------------------------------------
+# semantic_diff
+# ----------------------------------------------------------------------------
+# Diff two config files block by block (see config_blocks). Only changed
+# blocks are listed, each with a header "@@ <block>" and the lines removed
+# and added, so the output names the object that drifted. Returns list of
+# diff lines, at most max_lines, or an empty list if no block changed, e. g.
+# only the members of an object-group are in another order.
+#
+def semantic_diff(path1, path2, file1, file2, max_lines=DIFF_MAX_LINES):
+    blocks1 = config_blocks(parse_config(path1))
+    blocks2 = config_blocks(parse_config(path2))
+    output = [ f"--- {file1}", f"+++ {file2}" ]
+    for name in list(blocks1) + [ n for n in blocks2 if n not in blocks1 ]:
+        ordered1, unordered1 = blocks1.get(name, ([], set()))
+        ordered2, unordered2 = blocks2.get(name, ([], set()))
+        if ordered1 == ordered2 and unordered1 == unordered2:
+            continue
+        output.append(f"@@ {name}")
+        matcher = difflib.SequenceMatcher(None, ordered1, ordered2, autojunk=False)
+        for tag, x0, x1, y0, y1 in matcher.get_opcodes():
+            if tag != "equal":
+                output += [ "-" + l for l in ordered1[x0:x1] ]
+                output += [ "+" + l for l in ordered2[y0:y1] ]
+        output += [ "-" + l for l in sorted(unordered1 - unordered2) ]
+        output += [ "+" + l for l in sorted(unordered2 - unordered1) ]
+        if len(output) > max_lines:
+            break
+    if len(output) == 2:
+        return([])
+    if len(output) > max_lines:
+        output = output[:max_lines]
+        output.append(f"... diff truncated after {max_lines} lines.")
+    return(output)
+
+
+
+# ----------------------------------------------------------------------------
+# compare_files
+# ----------------------------------------------------------------------------
+# Compare two config files. They are equal if the file hashes or their
+# Cryptochecksums match, which is checked in one streaming pass. Otherwise
+# the files are diffed, limited to max_lines: stanza by stanza as unified
+# diff (mode text) or block by block (mode semantic, see semantic_diff).
+# In mode semantic the files are also equal if no block changed. Runs in a
+# worker process, so nothing is printed. Returns dict with the result of
+# the comparison: files, equal, sha256, checksum, size and lines of both
+# files, the diff statistics, an error message and the diff lines.
+#
+def compare_files(dir, file1, file2, max_lines=DIFF_MAX_LINES, mode="text"):
+    start = time.monotonic()
+    path1 = dir + "/" + file1
+    path2 = dir + "/" + file2
+    result = {
+        "file1": file1,
+        "file2": file2,
+        "equal": False,
+        "error": None,
+        "diff":  [],
+    }
+    try:
+        scan1 = scan_config(path1)
+        scan2 = scan_config(path2)
+        for key in ("sha256", "checksum", "size", "lines"):
+            result[key] = [ scan1[key], scan2[key] ]
+        if scan1["sha256"] == scan2["sha256"]:
+            result["equal"] = True
+        elif scan1["checksum"] and scan1["checksum"] == scan2["checksum"]:
+            result["equal"] = True
+        elif mode == "semantic":
+            result["diff"] = semantic_diff(path1, path2, file1, file2, max_lines)
+            result["equal"] = not result["diff"]
+        else:
+            result["diff"] = diff_configs(path1, path2, file1, file2, max_lines)
+    except Exception as e:
+        result["error"] = f"Reading files {file1}, {file2} failed: {e}"
+    body = result["diff"][2:]
+    result["diff_stats"] = {
+        "hunks":     sum(1 for l in body if l.startswith("@@")),
+        "added":     sum(1 for l in body if l.startswith("+")),
+        "removed":   sum(1 for l in body if l.startswith("-")),
+        "truncated": bool(body) and body[-1].startswith("... diff truncated"),
+    }
+    result["seconds"] = round(time.monotonic() - start, 3)
+    return(result)
+
+
+
+# ----------------------------------------------------------------------------
+# get_process_pool
+# ----------------------------------------------------------------------------
+# Returns the process pool shared by all firewall jobs for CPU bound work
+# like comparing configs. Created on first use with one worker per CPU. The
+# workers are spawned, forking a process with running threads is unsafe.
+#
+PROCESS_POOL = None
+PROCESS_POOL_LOCK = threading.Lock()
+
+def get_process_pool():
+    global PROCESS_POOL
+    with PROCESS_POOL_LOCK:
+        if PROCESS_POOL is None:
+            PROCESS_POOL = ProcessPoolExecutor(max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn"))
+    return(PROCESS_POOL)
+
+
+
+# ----------------------------------------------------------------------------
+# list_directory
+# ----------------------------------------------------------------------------
+# Returns listing of a directory similar to "ls -al" as string.
+#
+def list_directory(dir):
+    lines = []
+    total = 0
+    for entry in sorted(os.scandir(dir), key=lambda e: e.name):
+        st = entry.stat(follow_symlinks=False)
+        total += st.st_size
+        mtime = datetime.fromtimestamp(st.st_mtime).strftime("%Y-%m-%d %H:%M")
+        lines.append(f"{stat.filemode(st.st_mode)} {st.st_nlink:>2} {st.st_size:>12} {mtime} {entry.name}")
+    lines.insert(0, f"total {total} bytes")
+    return("\n".join(lines))
+
+
+
+# ----------------------------------------------------------------------------
+# verify_backup
+# ----------------------------------------------------------------------------
+# Startup-config and running-config should be the same. Otherwise a write mem
+# has been forgotten. Config on active and standby unit should also be the
+# same or replication has failed.
+# All pairs are compared in parallel in the process pool. The result of each
+# pair is written to verify.json in destdir for monitoring.
+# 
+def verify_backup(destdir, failover_units, contexts, max_lines=DIFF_MAX_LINES, mode="text"):
+    log(f"Verifying backup on {destdir}:")
+    log(list_directory(destdir))
+    log("")
+    pairs = [ ("startup-config_active.cfg", "running-config_active.cfg") ]
+    if "standby" in failover_units:
+        pairs.append(("startup-config_standby.cfg", "running-config_standby.cfg"))
+        for context in contexts:
+            pairs.append((f"context_{context}_active.cfg", f"context_{context}_standby.cfg"))
+    if len(pairs) > 1:
+        pool = get_process_pool()
+        futures = [ pool.submit(compare_files, destdir, f1, f2, max_lines, mode) for f1, f2 in pairs ]
+        results = [ future.result() for future in futures ]
+    else:
+        results = [ compare_files(destdir, f1, f2, max_lines, mode) for f1, f2 in pairs ]
+    for result in results:
+        if result["error"]:
+            log(f"ERROR: {result['error']}")
+        elif not result["equal"]:
+            log("-" * 80)
+            log(f"Files {result['file1']} and {result['file2']} differ:")
+            log("-" * 80)
+            log("\n".join(result["diff"]))
+        if (run := REPORT.get()) is not None:
+            run["phases"].append({
+                "phase":   "verify",
+                "step":    "compare",
+                "file":    result["file1"],
+                "peer":    result["file2"],
+                "seconds": result["seconds"],
+                "bytes":   sum(result.get("size", [])),
+            })
+    report = {
+        "destdir": destdir,
+        "date":    datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "pairs":   [ { k: v for k, v in r.items() if k != "diff" } for r in results ],
+    }
+    try:
+        with open(os.path.join(destdir, "verify.json"), 'w') as file:
+            json.dump(report, file, indent=2)
+    except Exception as e:
+        log(f"ERROR: Writing verify.json failed: {e}")
+    return(results)
+
+
+
+# ----------------------------------------------------------------------------
+# hash_file
+# ----------------------------------------------------------------------------
+# Returns the SHA-256 hex digest of a file, read in chunks. The digest is
+# cached, a file is not read again unless it changed since. Files received
+# by the embedded SCP receiver were hashed while writing.
+#
+FILE_HASHES = {}
+FILE_HASHES_LOCK = threading.Lock()
+
+def hash_file(file_path):
+    st = os.stat(file_path)
+    with FILE_HASHES_LOCK:
+        cached = FILE_HASHES.get(file_path)
+    if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+        return(cached[2])
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    with FILE_HASHES_LOCK:
+        FILE_HASHES[file_path] = (st.st_size, st.st_mtime_ns, digest.hexdigest())
+    return(digest.hexdigest())
+
+
+
+# ----------------------------------------------------------------------------
+# get_object_path
+# ----------------------------------------------------------------------------
+# Returns path of an object in the content-addressed store of a firewall.
+#
+def get_object_path(fwdir, digest):
+    return(os.path.join(fwdir, "objects", digest[:2], digest[2:]))
+
+
+
+# ----------------------------------------------------------------------------
+# read_manifest
+# ----------------------------------------------------------------------------
+# Read the manifest of a slot from the object store. Returns dict with slot,
+# date and files (filename -> {sha256, size}) or None if there is none.
+#
+def read_manifest(fwdir, slot):
+    try:
+        with open(os.path.join(fwdir, "manifests", f"{slot}.json"), 'r') as file:
+            return(json.load(file))
+    except FileNotFoundError:
+        return(None)
+
+
+
+# ----------------------------------------------------------------------------
+# find_slot_file
+# ----------------------------------------------------------------------------
+# Returns path of a file of a slot, either in the slot directory or in the
+# object store according to the slot manifest. None if not found.
+#
+def find_slot_file(fwdir, slot, file):
+    file_path = os.path.join(fwdir, slot, file)
+    if os.path.isfile(file_path):
+        return(file_path)
+    manifest = read_manifest(fwdir, slot)
+    if manifest and file in manifest["files"]:
+        file_path = get_object_path(fwdir, manifest["files"][file]["sha256"])
+        if os.path.isfile(file_path):
+            return(file_path)
+    return(None)
+
+
+
+# ----------------------------------------------------------------------------
+# store_objects
+# ----------------------------------------------------------------------------
+# Move the files of a slot directory into the content-addressed object store
+# of the firewall. Each file is stored once under its SHA-256 hash in
+# objects/, identical files of other slots and runs are not stored again.
+# A manifest manifests/<slot>.json maps the filenames to their hashes. The
+# slot directory is removed afterwards, see restore_slot to rebuild it.
+#
+def store_objects(fwdir, slot, dt):
+    destdir = os.path.join(fwdir, slot)
+    manifest = {
+        "slot":  slot,
+        "date":  dt.strftime("%Y-%m-%d %H:%M:%S"),
+        "files": {},
+    }
+    stored = 0
+    for entry in sorted(os.scandir(destdir), key=lambda e: e.name):
+        if not entry.is_file():
+            continue
+        digest = hash_file(entry.path)
+        size = entry.stat().st_size
+        object_path = get_object_path(fwdir, digest)
+        if os.path.exists(object_path):
+            os.unlink(entry.path)
+        else:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(entry.path, object_path)
+            os.chmod(object_path, 0o400)
+            stored += size
+        manifest["files"][entry.name] = { "sha256": digest, "size": size }
+    os.makedirs(os.path.join(fwdir, "manifests"), exist_ok=True)
+    file_path = os.path.join(fwdir, "manifests", f"{slot}.json")
+    with open(file_path + ".tmp", 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(file_path + ".tmp", file_path)
+    shutil.rmtree(destdir)
+    total = sum(f["size"] for f in manifest["files"].values())
+    log(f"Stored {len(manifest['files'])} files of slot {slot}, {stored} of {total} bytes new.")
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# collect_garbage
+# ----------------------------------------------------------------------------
+# Remove objects no longer referenced by any manifest. The retention policy
+# is enforced by the slot names (see get_retention_slot): a new backup
+# replaces the manifest of the same slot, so the objects only referenced by
+# the old manifest are removed here. Returns number of bytes freed.
+#
+def collect_garbage(fwdir):
+    referenced = set()
+    manifests = os.path.join(fwdir, "manifests")
+    if os.path.isdir(manifests):
+        for entry in os.scandir(manifests):
+            if entry.name.endswith(".json"):
+                with open(entry.path, 'r') as file:
+                    manifest = json.load(file)
+                referenced.update(f["sha256"] for f in manifest["files"].values())
+    freed = 0
+    objects = os.path.join(fwdir, "objects")
+    if os.path.isdir(objects):
+        for prefix in os.scandir(objects):
+            for entry in os.scandir(prefix.path):
+                if prefix.name + entry.name not in referenced:
+                    freed += entry.stat().st_size
+                    os.unlink(entry.path)
+    return(freed)
+
+
+
+# ----------------------------------------------------------------------------
+# restore_slot
+# ----------------------------------------------------------------------------
+# Rebuild a slot directory from its manifest by copying the objects to
+# outdir. Each copy is checked against the hash in the manifest.
+# Returns True on success.
+#
+def restore_slot(fwdir, slot, outdir):
+    manifest = read_manifest(fwdir, slot)
+    if not manifest:
+        log(f"ERROR: No manifest for slot {slot} in {fwdir}.")
+        return(False)
+    os.makedirs(outdir, exist_ok=True)
+    success = True
+    for file, meta in sorted(manifest["files"].items()):
+        dst = os.path.join(outdir, file)
+        try:
+            shutil.copyfile(get_object_path(fwdir, meta["sha256"]), dst)
+            if hash_file(dst) != meta["sha256"]:
+                raise ValueError("checksum mismatch")
+        except Exception as e:
+            log(f"ERROR: Restoring {file} failed: {e}")
+            success = False
+    log(f"Restored {len(manifest['files'])} files of slot {slot} ({manifest['date']}) to {outdir}.")
+    return(success)
+
+
+
+# ----------------------------------------------------------------------------
+# open_history
+# ----------------------------------------------------------------------------
+# Open the config history archive history.sqlite of a firewall, creating it
+# if needed. Table versions holds every distinct version of each config
+# file, zlib compressed: a full copy every HISTORY_KEYFRAME versions and
+# otherwise the delta to the previous version (see make_delta). Table lines
+# is the line index: each distinct line of a file with the versions it was
+# added and removed in, NULL while still present. Its full-text index
+# lines_text (FTS5 with trigrams) finds the lines containing a text for
+# search_history. It is filled by a trigger, and built for archives created
+# without it. SQLite without FTS5 trigrams makes do without the index.
+#
+HISTORY_FILE = "history.sqlite"
+HISTORY_KEYFRAME = 32
+
+def open_history(fwdir):
+    db = sqlite3.connect(os.path.join(fwdir, HISTORY_FILE))
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS versions (
+            id      INTEGER PRIMARY KEY,
+            file    TEXT NOT NULL,
+            date    TEXT NOT NULL,
+            slot    TEXT NOT NULL,
+            sha256  TEXT NOT NULL,
+            base    INTEGER,
+            depth   INTEGER NOT NULL,
+            data    BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS versions_file ON versions (file, date);
+        CREATE TABLE IF NOT EXISTS lines (
+            file    TEXT NOT NULL,
+            line    TEXT NOT NULL,
+            added   INTEGER NOT NULL,
+            removed INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS lines_file ON lines (file, removed);
+        DROP INDEX IF EXISTS lines_line;
+    """)
+    if not db.execute("SELECT 1 FROM sqlite_master WHERE name = 'lines_text'").fetchone():
+        try:
+            with db:
+                db.executescript("""
+                    CREATE VIRTUAL TABLE lines_text USING fts5 (line, content = 'lines',
+                        content_rowid = 'rowid', tokenize = 'trigram case_sensitive 1');
+                    CREATE TRIGGER lines_text_insert AFTER INSERT ON lines BEGIN
+                        INSERT INTO lines_text (rowid, line) VALUES (new.rowid, new.line);
+                    END;
+                    INSERT INTO lines_text (lines_text) VALUES ('rebuild');
+                """)
+        except sqlite3.OperationalError:
+            pass
+    return(db)
+
+
+
+# ----------------------------------------------------------------------------
+# make_delta
+# ----------------------------------------------------------------------------
+# Returns the delta from one list of lines to another as list of
+# [ start, end, lines ]: replace old[start:end] with lines. The lines are
+# matched with a patience diff (see patience_matches).
+#
+def make_delta(old, new):
+    delta = []
+    i = j = 0
+    for mi, mj in patience_matches(old, new) + [ (len(old), len(new)) ]:
+        if i < mi or j < mj:
+            delta.append([ i, mi, new[j:mj] ])
+        i, j = mi + 1, mj + 1
+    return(delta)
+
+
+
+# ----------------------------------------------------------------------------
+# apply_delta
+# ----------------------------------------------------------------------------
+# Returns the list of lines made from old and a delta of make_delta.
+#
+def apply_delta(old, delta):
+    new = []
+    position = 0
+    for start, end, lines in delta:
+        new += old[position:start]
+        new += lines
+        position = end
+    new += old[position:]
+    return(new)
+
+
+
+# ----------------------------------------------------------------------------
+# read_version
+# ----------------------------------------------------------------------------
+# Returns the lines of a version from the history archive, rebuilt from the
+# last full copy and the deltas after it.
+#
+def read_version(db, version):
+    chain = []
+    while version is not None:
+        base, data = db.execute("SELECT base, data FROM versions WHERE id = ?",
+            (version,)).fetchone()
+        chain.append(json.loads(zlib.decompress(data)))
+        version = base
+    lines = chain.pop()
+    while chain:
+        lines = apply_delta(lines, chain.pop())
+    return(lines)
+
+
+
+# ----------------------------------------------------------------------------
+# archive_configs
+# ----------------------------------------------------------------------------
+# Add the config files (*.cfg) of a slot directory to the history archive
+# of the firewall. A file is only added if it differs from its last version.
+# Returns number of versions added.
+#
+def archive_configs(fwdir, destdir, slot, dt):
+    date = dt.strftime("%Y-%m-%d %H:%M:%S")
+    added = 0
+    with contextlib.closing(open_history(fwdir)) as db, db:
+        for entry in sorted(os.scandir(destdir), key=lambda e: e.name):
+            if not entry.is_file() or not entry.name.endswith(".cfg"):
+                continue
+            with open(entry.path, 'r', encoding='utf-8', errors='replace', newline='') as file:
+                lines = file.readlines()
+            digest = hash_file(entry.path)
+            last = db.execute("SELECT id, sha256, depth FROM versions WHERE file = ? "
+                "ORDER BY date DESC, id DESC LIMIT 1", (entry.name,)).fetchone()
+            if last and last[1] == digest:
+                continue
+            if last and last[2] + 1 < HISTORY_KEYFRAME:
+                base, depth = last[0], last[2] + 1
+                data = make_delta(read_version(db, last[0]), lines)
+            else:
+                base, depth, data = None, 0, lines
+            version = db.execute("INSERT INTO versions (file, date, slot, sha256, base, depth, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", (entry.name, date, slot, digest, base, depth,
+                zlib.compress(json.dumps(data).encode(), 9))).lastrowid
+            present = dict(db.execute("SELECT line, rowid FROM lines WHERE file = ? "
+                "AND removed IS NULL", (entry.name,)))
+            current = set(line.rstrip('\r\n') for line in lines)
+            db.executemany("INSERT INTO lines (file, line, added) VALUES (?, ?, ?)",
+                [ (entry.name, line, version) for line in current if line not in present ])
+            db.executemany("UPDATE lines SET removed = ? WHERE rowid = ?",
+                [ (version, rowid) for line, rowid in present.items() if line not in current ])
+            added += 1
+    log(f"Archived {added} changed config files in {HISTORY_FILE}.")
+    return(added)
+
+
+
+# ----------------------------------------------------------------------------
+# query_history
+# ----------------------------------------------------------------------------
+# Print a config file as it was at the given time ("YYYY-MM-DD HH:MM:SS" or
+# a prefix of it) from the history archive. Without a file, list the files
+# with their number of versions and the dates of the first and last one.
+# Returns True on success.
+#
+def query_history(fwdir, file=None, at=None):
+    if not os.path.isfile(os.path.join(fwdir, HISTORY_FILE)):
+        log(f"ERROR: No config history in {fwdir}.")
+        return(False)
+    with contextlib.closing(open_history(fwdir)) as db:
+        if not file:
+            for row in db.execute("SELECT file, COUNT(*), MIN(date), MAX(date) FROM versions "
+                    "GROUP BY file ORDER BY file"):
+                log("{:<40}  {:>5} versions  {}  {}".format(*row))
+            return(True)
+        at = (at or "9999") + "\uffff"
+        row = db.execute("SELECT id, date, slot, sha256 FROM versions WHERE file = ? AND date <= ? "
+            "ORDER BY date DESC, id DESC LIMIT 1", (file, at)).fetchone()
+        if not row:
+            log(f"ERROR: No version of {file} at {at[:-1]} in {fwdir}.")
+            return(False)
+        content = "".join(read_version(db, row[0]))
+    if hashlib.sha256(content.encode()).hexdigest() != row[3]:
+        log(f"WARNING: Version of {file} from {row[1]} does not match its checksum.")
+    log(f"# {file} from {row[1]} (slot {row[2]})")
+    sys.stdout.write(content)
+    return(True)
+
+
+
+# ----------------------------------------------------------------------------
+# search_history
+# ----------------------------------------------------------------------------
+# Print all lines of the config history containing the pattern (case
+# sensitive) with the file and the dates the line was added and removed.
+# Only the line index is searched, no versions are rebuilt. Patterns of
+# three or more characters are looked up in the trigram index lines_text.
+# For shorter patterns, or without the index, all lines are scanned.
+# Returns number of matches.
+#
+def search_history(fwdir, pattern):
+    if not os.path.isfile(os.path.join(fwdir, HISTORY_FILE)):
+        log(f"ERROR: No config history in {fwdir}.")
+        return(0)
+    with contextlib.closing(open_history(fwdir)) as db:
+        query = ("SELECT lines.file, added.date, removed.date, lines.line FROM lines "
+            "JOIN versions AS added ON added.id = lines.added "
+            "LEFT JOIN versions AS removed ON removed.id = lines.removed "
+            "WHERE instr(lines.line, ?) > 0 ")
+        params = [ pattern ]
+        if len(pattern) >= 3 and db.execute("SELECT 1 FROM sqlite_master "
+                                            "WHERE name = 'lines_text'").fetchone():
+            query += "AND lines.rowid IN (SELECT rowid FROM lines_text WHERE lines_text MATCH ?) "
+            params.append('"' + pattern.replace('"', '""') + '"')
+        rows = db.execute(query + "ORDER BY lines.file, added.date", params).fetchall()
+    for file, added, removed, line in rows:
+        log(f"{file:<40}  {added}  {removed or 'present':<19}  {line}")
+    return(len(rows))
+
+
+
+# ----------------------------------------------------------------------------
+# ScpReceiver
+# ----------------------------------------------------------------------------
+# Embedded SCP server on the backup host, used instead of the system sshd for
+# firewalls with receiver: embedded. It runs for the length of the backup
+# run and accepts the copy uploads of the firewalls (scp -t sink protocol).
+# Each firewall job registers its slot directory with the backup-username
+# and backup-password of the firewall, uploads are only accepted into the
+# directory registered with the credentials of the session. Files are hashed
+# while writing (see hash_file) and the throughput of each file is logged
+# with the log prefix of the job, like failed uploads and authentication and
+# protocol errors.
+# Built on paramiko's server API, imported only when the receiver is used.
+#
+class ScpReceiver:
+
+    def __init__(self, port, host_key_file):
+        self.port = port
+        self.host_key_file = os.path.expanduser(host_key_file)
+        self.lock = threading.Lock()
+        self.targets = {}
+        self.sock = None
+        self.running = False
+
+    def start(self):
+        import paramiko
+        if os.path.exists(self.host_key_file):
+            self.host_key = paramiko.RSAKey.from_private_key_file(self.host_key_file)
+        else:
+            self.host_key = paramiko.RSAKey.generate(3072)
+            self.host_key.write_private_key_file(self.host_key_file)
+            os.chmod(self.host_key_file, 0o600)
+            log(f"Host key of SCP receiver created at {self.host_key_file}.")
+        self.server_class = scp_server_class(paramiko)
+        self.sock = socket.create_server(("", self.port))
+        self.sock.settimeout(1)
+        self.running = True
+        threading.Thread(target=self.accept_connections, daemon=True).start()
+        log(f"SCP receiver listening on port {self.port}, host key fingerprint "
+            f"SHA256:{self.host_key.fingerprint.split(':', 1)[-1]}.")
+        return
+
+    def stop(self):
+        self.running = False
+        if self.sock:
+            self.sock.close()
+        return
+
+    def register(self, destdir, username, password):
+        with self.lock:
+            self.targets[os.path.realpath(destdir)] = {
+                "username": username,
+                "password": password,
+                "prefix":   LOG_PREFIX.get(),
+                "files":    0,
+                "bytes":    0,
+                "seconds":  0.0,
+            }
+        return
+
+    def unregister(self, destdir):
+        with self.lock:
+            target = self.targets.pop(os.path.realpath(destdir), None)
+        if target and target["files"]:
+            rate = target["bytes"] / max(target["seconds"], 1e-6) / 1e6
+            log(f"SCP receiver got {target['files']} files, {target['bytes']} bytes, {rate:.1f} MB/s.")
+        return
+
+    def check_password(self, username, password):
+        with self.lock:
+            return(any(t["username"] == username and t["password"] == password
+                       for t in self.targets.values()))
+
+    def find_target(self, username, password, file_path):
+        with self.lock:
+            target = self.targets.get(os.path.dirname(file_path))
+        if target and target["username"] == username and target["password"] == password:
+            return(target)
+        return(None)
+
+    def reject(self, channel, message):
+        log(f"ERROR: SCP receiver: {message}")
+        channel.sendall(f"\x02{message}\n".encode())
+        return(1)
+
+    def accept_connections(self):
+        while self.running:
+            try:
+                client, address = self.sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            threading.Thread(target=self.handle_connection, args=(client, address),
+                             daemon=True).start()
+        return
+
+    def handle_connection(self, client, address):
+        import paramiko
+        transport = paramiko.Transport(client)
+        try:
+            transport.add_server_key(self.host_key)
+            server = self.server_class(self)
+            transport.start_server(server=server)
+            channel = transport.accept(60)
+            if channel and server.command.wait(60):
+                status = self.receive_files(channel, server.username, server.password,
+                                            server.command.text)
+                channel.send_exit_status(status)
+                channel.close()
+        except Exception as e:
+            log(f"ERROR: SCP receiver: Connection from {address[0]} failed: {e}")
+        finally:
+            transport.close()
+        return
+
+    def receive_files(self, channel, username, password, command):
+        args = shlex.split(command)
+        if len(args) < 3 or args[0] != "scp" or "-t" not in args[1:-1]:
+            return(self.reject(channel, "Only scp uploads are supported."))
+        dest = os.path.realpath(args[-1])
+        stream = channel.makefile('rb')
+        channel.sendall(b"\0")
+        while line := stream.readline():
+            if line[:1] in (b"T", b"E"):
+                channel.sendall(b"\0")
+                continue
+            if line[:1] != b"C":
+                if line[:1] == b"D":
+                    return(self.reject(channel, "Directories are not supported."))
+                return(self.reject(channel, f"Unexpected scp message {line[:1]!r}."))
+            mode, size, name = line[1:].decode().rstrip("\n").split(" ", 2)
+            file_path = dest
+            if os.path.isdir(dest) or "-d" in args[1:-1]:
+                file_path = os.path.join(dest, name)
+            target = None
+            if "/" not in name and name not in (".", ".."):
+                target = self.find_target(username, password, file_path)
+            if not target:
+                return(self.reject(channel, f"Permission denied for {username}: {file_path}"))
+            LOG_PREFIX.set(target["prefix"])
+            channel.sendall(b"\0")
+            if not self.receive_file(stream, file_path, int(size), target):
+                return(self.reject(channel, f"Receiving {name} failed, upload incomplete."))
+            channel.sendall(b"\0")
+        return(0)
+
+    def receive_file(self, stream, file_path, size, target):
+        start = time.monotonic()
+        digest = hashlib.sha256()
+        remaining = size
+        with open(file_path + ".part", 'wb') as file:
+            while remaining > 0:
+                chunk = stream.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                file.write(chunk)
+                remaining -= len(chunk)
+        if remaining > 0 or stream.read(1) != b"\0":
+            os.unlink(file_path + ".part")
+            return(False)
+        os.replace(file_path + ".part", file_path)
+        seconds = time.monotonic() - start
+        st = os.stat(file_path)
+        with FILE_HASHES_LOCK:
+            FILE_HASHES[file_path] = (st.st_size, st.st_mtime_ns, digest.hexdigest())
+        with self.lock:
+            target["files"] += 1
+            target["bytes"] += size
+            target["seconds"] += seconds
+        rate = size / max(seconds, 1e-6) / 1e6
+        log(f"Received {os.path.basename(file_path)}: {size} bytes in {seconds:.2f}s, {rate:.1f} MB/s")
+        return(True)
+
+
+
+# ----------------------------------------------------------------------------
+# scp_server_class
+# ----------------------------------------------------------------------------
+# Returns the paramiko server interface class of the SCP receiver. Accepts
+# password authentication with the registered credentials and a single exec
+# request with the scp command per session.
+#
+def scp_server_class(paramiko):
+
+    class ScpServer(paramiko.ServerInterface):
+
+        def __init__(self, receiver):
+            self.receiver = receiver
+            self.username = None
+            self.password = None
+            self.command = threading.Event()
+            self.command.text = ""
+
+        def get_allowed_auths(self, username):
+            return("password")
+
+        def check_auth_password(self, username, password):
+            if self.receiver.check_password(username, password):
+                self.username = username
+                self.password = password
+                return(paramiko.AUTH_SUCCESSFUL)
+            log(f"ERROR: SCP receiver: Authentication of {username} failed.")
+            return(paramiko.AUTH_FAILED)
+
+        def check_channel_request(self, kind, chanid):
+            if kind == "session":
+                return(paramiko.OPEN_SUCCEEDED)
+            return(paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED)
+
+        def check_channel_exec_request(self, channel, command):
+            self.command.text = command.decode(errors="replace")
+            self.command.set()
+            return(True)
+
+    return(ScpServer)
+
+
+
+# ----------------------------------------------------------------------------
+# start_receiver
+# ----------------------------------------------------------------------------
+# Start the embedded SCP receiver if any of the firewalls has receiver:
+# embedded. The copy URL of the ASA has no port, so the receiver listens on
+# port 22, with the receiver-host-key of the first of these firewalls.
+# Returns ScpReceiver or None. Aborts if the receiver cannot be started,
+# e. g. the port is in use by sshd.
+#
+SCP_PORT = 22
+RECEIVER = None
+
+def start_receiver(cfg, firewalls):
+    for fw in firewalls:
+        if cfg["firewalls"][fw].receiver != "embedded":
+            continue
+        receiver = ScpReceiver(SCP_PORT, cfg["firewalls"][fw].receiver_host_key)
+        try:
+            receiver.start()
+        except Exception as e:
+            sys.exit(f"ERROR: Starting SCP receiver on port {SCP_PORT} failed: {e}")
+        return(receiver)
+    return(None)
+
+
+
+# ----------------------------------------------------------------------------
+# write_report
+# ----------------------------------------------------------------------------
+# Write the run report of a firewall job with the measured phases (see
+# measure) to the slot directory: report.json and report.prom in OpenMetrics
+# text format, e. g. for the node_exporter textfile collector. Phases with
+# the same labels are summed up.
+#
+REPORT_LABELS = ( "phase", "unit", "context", "step", "file", "peer" )
+
+def write_report(job, success):
+    report = job["report"]
+    report["success"] = success
+    report["seconds"] = round(time.monotonic() - job["start"], 3)
+    totals = {}
+    for record in report["phases"]:
+        labels = tuple((k, record[k]) for k in REPORT_LABELS if record.get(k) is not None)
+        seconds, size = totals.get(labels, (0.0, 0))
+        totals[labels] = (seconds + record["seconds"], size + record["bytes"])
+
+    def metric(name, labels, value):
+        labels = (("firewall", report["firewall"]),) + labels
+        text = ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                                         .replace('\n', '\\n')) for k, v in labels)
+        return(f"{name}{{{text}}} {value}")
+
+    lines = [
+        "# TYPE asa_backup_phase_seconds gauge",
+        "# UNIT asa_backup_phase_seconds seconds",
+        "# HELP asa_backup_phase_seconds Wall-clock time of a backup phase.",
+    ]
+    lines += [ metric("asa_backup_phase_seconds", k, round(v[0], 3)) for k, v in totals.items() ]
+    lines += [
+        "# TYPE asa_backup_phase_bytes gauge",
+        "# UNIT asa_backup_phase_bytes bytes",
+        "# HELP asa_backup_phase_bytes Bytes transferred in a backup phase.",
+    ]
+    lines += [ metric("asa_backup_phase_bytes", k, v[1]) for k, v in totals.items() if v[1] ]
+    lines += [
+        "# TYPE asa_backup_run_seconds gauge",
+        "# UNIT asa_backup_run_seconds seconds",
+        "# HELP asa_backup_run_seconds Wall-clock time of the backup run.",
+        metric("asa_backup_run_seconds", (), report["seconds"]),
+        "# TYPE asa_backup_success gauge",
+        "# HELP asa_backup_success 1 if the backup run succeeded.",
+        metric("asa_backup_success", (), int(success)),
+        "# EOF",
+    ]
+    try:
+        with open(os.path.join(job["destdir"], "report.json"), 'w') as file:
+            json.dump(report, file, indent=2)
+        with open(os.path.join(job["destdir"], "report.prom"), 'w') as file:
+            file.write("\n".join(lines) + "\n")
+    except Exception as e:
+        log(f"ERROR: Writing run report failed: {e}")
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# prepare_firewall
+# ----------------------------------------------------------------------------
+# Check that the firewall is reachable, create the backup directory and
+# print the header. Returns a dict with the backup job of the firewall or
+# None if the firewall cannot be backed up. The job holds the settings of
+# the firewall and collects the results of the collection (failover units,
+# contexts, checksums and facts).
+#
+def prepare_firewall(cfg, fw):
+    fwcfg = cfg["firewalls"][fw]
+    hostname = fwcfg.hostname
+    if fwcfg.unreachable:
+        log(f"ERROR: Host {hostname} is {fwcfg.unreachable}!")
+        return(None)
+
+    dt = datetime.now()
+    slot = get_retention_slot(dt)
+    fwdir = "/".join([fwcfg.backup_dir, fw])
+    destdir = "/".join([fwdir, slot])
+    backup_url = "scp://{}:{}@{}/{}".format(
+        fwcfg.backup_username,
+        fwcfg.backup_password,
+        fwcfg.backup_host, destdir
+    )
+    cisco_asa = {
+        "host":                  fwcfg.address or hostname,
+        "port":                  fwcfg.port,
+        "device_type":           "cisco_asa",
+        "username":              fwcfg.username,
+        "password":              fwcfg.password,
+        "secret":                fwcfg.enable_secret,
+        "read_timeout_override": fwcfg.read_timeout,
+        "conn_timeout":          fwcfg.conn_timeout,
+        "session_log":           destdir + "/" + "session.log",
+        "use_keys":              fwcfg.use_key,
+        "key_file":              fwcfg.ssh_key,
+        "keepalive":             fwcfg.keepalive,
+        "disable_sha2_fix":      True,
+        "verbose":               False,
+        "retries":               fwcfg.retries,
+        "retry_delay":           fwcfg.retry_delay,
+    }
+    job = {
+        "fw":               fw,
+        "hostname":         hostname,
+        "dt":               dt,
+        "slot":             slot,
+        "fwdir":            fwdir,
+        "destdir":          destdir,
+        "backup_url":       backup_url,
+        "passphrase":       fwcfg.password,
+        "standby_hostname": fwcfg.standby_hostname,
+        "depth":            fwcfg.pipeline_depth,
+        "incremental":      fwcfg.incremental,
+        "storage":          fwcfg.storage,
+        "diff_max_lines":   fwcfg.diff_max_lines,
+        "diff_mode":        fwcfg.diff_mode,
+        "facts_ttl":        fwcfg.facts_ttl,
+        "history":          fwcfg.history,
+        "compression":      fwcfg.compression,
+        "tech_support_stream": fwcfg.tech_support_stream,
+        "cisco_asa":        cisco_asa,
+        "failover_units":   [ "active" ],
+        "contexts":         [],
+        "checksums":        {},
+        "skipped":          {},
+        "facts":            {},
+        "receiver":         None,
+        "journal":          None,
+        "start":            time.monotonic(),
+        "report":           {
+            "firewall": fw,
+            "hostname": hostname,
+            "slot":     slot,
+            "date":     dt.strftime("%Y-%m-%d %H:%M:%S"),
+            "destdir":  destdir,
+            "phases":   [],
+        },
+    }
+
+    log("")
+    log("=" * 80)
+    log("Firewall name   : {}".format(fw))
+    log("Firewall host   : {}".format(hostname))
+    log("Backup host     : {}".format(fwcfg.backup_host))
+    log("Backup directory: {}".format(destdir))
+    log("Backup date/time: {}".format(dt.strftime("%Y-%m-%d %H:%M:%S")))
+    log("=" * 80)
+    log("")
+
+    try:
+        if not os.path.exists(destdir):
+            os.makedirs(destdir)
+        else:
+            timestamp = dt.timestamp() 
+            os.utime(destdir, (timestamp, timestamp))
+    except Exception as e:
+        log(f"ERROR: Creating directory {destdir} failed: {e}")
+        return(None)
+    if job["facts_ttl"]:
+        job["facts"] = load_facts(fwdir, job["facts_ttl"])
+    try:
+        job["journal"] = open_journal(destdir, dt, fwcfg.resume)
+    except Exception as e:
+        log(f"ERROR: Opening journal in {destdir} failed: {e}")
+        return(None)
+    if fwcfg.receiver == "embedded":
+        job["receiver"] = RECEIVER
+        job["receiver"].register(destdir, fwcfg.backup_username,
+                                 fwcfg.backup_password)
+    return(job)
+
+
+
+# ----------------------------------------------------------------------------
+# collect_firewall
+# ----------------------------------------------------------------------------
+# Collect tech-support, configs and backups of all units of a firewall with
+# Netmiko. Raises an exception if the collection failed.
+#
+def collect_firewall(job):
+    cisco_asa = job["cisco_asa"]
+    backup_url = job["backup_url"]
+    passphrase = job["passphrase"]
+    depth = job["depth"]
+    stream_dir = job["destdir"] if job["tech_support_stream"] else None
+    copy_conn = None
+    try:
+        with measure("connect", unit="active"):
+            conn = ManagedConnection(cisco_asa)
+        with conn:
+            facts = job["facts"] = check_facts(conn, job["facts"])
+            context_mode = get_context_mode(conn, facts)
+            failover_units = job["failover_units"] = get_failover_units(conn, facts)
+            standby_host = None
+            if "standby" in failover_units and job["standby_hostname"]:
+                if job["standby_hostname"] == "auto":
+                    standby_host = get_standby_address(conn, cisco_asa["host"], facts)
+                    if not standby_host:
+                        log("WARNING: Standby unit address not found in failover status.")
+                else:
+                    standby_host = job["standby_hostname"]
+            if context_mode == "multiple":
+                ihack = ""
+                conn.send_command("changeto system")
+                contexts = job["contexts"] = get_contexts(conn, facts)
+                if depth > 0:
+                    copy_conn = open_session(cisco_asa, "copy", context_mode)
+            else:
+                ihack = get_interface_hack(conn)
+                contexts = job["contexts"] = []
+            if job["facts_ttl"] and "checksum" not in facts:
+                facts["checksum"] = get_config_checksum(conn)
+            skip = {}
+            if job["incremental"]:
+                skip, job["checksums"] = prepare_incremental(conn, job["fwdir"], job["destdir"],
+                                                             failover_units, contexts)
+                job["skipped"] = skip
+            if standby_host:
+                # Collect standby unit over its own session at the same time.
+                with ThreadPoolExecutor(max_workers=1) as pool:
+                    standby = pool.submit(contextvars.copy_context().run,
+                        collect_standby, cisco_asa, standby_host, context_mode,
+                        backup_url, contexts, passphrase, depth, skip.get("standby", ()), facts,
+                        stream_dir)
+                    collect_unit(conn, "active", backup_url, ihack, contexts, passphrase,
+                                 False, copy_conn, depth, skip.get("active", ()), facts,
+                                 stream_dir)
+                    if not standby.result():
+                        log("Falling back to failover exec for standby unit ...")
+                        collect_unit(conn, "standby", backup_url, ihack, contexts, passphrase,
+                                     False, copy_conn, depth, skip.get("standby", ()), facts,
+                                     stream_dir)
+            else:
+                for unit in failover_units:
+                    collect_unit(conn, unit, backup_url, ihack, contexts, passphrase,
+                                 False, copy_conn, depth, skip.get(unit, ()), facts,
+                                 stream_dir)
+    finally:
+        close_session(copy_conn)
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# process_artifact
+# ----------------------------------------------------------------------------
+# Post-process one file of a slot directory in a worker process. Gzip files
+# (backup archives, streamed tech-support) are read through to check their
+# integrity and compared with the size the firewall reported for the copy.
+# Text files (*.txt, *.log) are compressed with xz or zstd if compression is
+# set, the original is removed. Returns dict with the final file name, its
+# size and SHA-256 hash and an error message or None.
+#
+COMPRESSION_SUFFIXES = { "xz": ".xz", "zstd": ".zst" }
+
+def process_artifact(file_path, compression=None, expected=None):
+    result = { "file": os.path.basename(file_path), "error": None }
+    try:
+        if file_path.endswith(".gz"):
+            size = os.path.getsize(file_path)
+            if expected is not None and size != expected:
+                raise ValueError(f"size {size} bytes, {expected} bytes copied by the firewall")
+            with gzip.open(file_path, 'rb') as file:
+                while file.read(1024 * 1024):
+                    pass
+        elif compression and file_path.endswith((".txt", ".log")):
+            target = file_path + COMPRESSION_SUFFIXES[compression]
+            with open(file_path, 'rb') as src, open(target + ".tmp", 'wb') as dst:
+                if compression == "zstd":
+                    try:
+                        import zstandard
+                    except ImportError:
+                        raise RuntimeError("Python module zstandard is required for compression zstd.")
+                    zstandard.ZstdCompressor().copy_stream(src, dst)
+                else:
+                    with lzma.open(dst, 'wb') as xz:
+                        shutil.copyfileobj(src, xz, 1024 * 1024)
+            os.replace(target + ".tmp", target)
+            os.unlink(file_path)
+            file_path = target
+            result["file"] = os.path.basename(target)
+    except Exception as e:
+        result["error"] = f"{result['file']}: {e}"
+    st = os.stat(file_path)
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    result.update({ "size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest.hexdigest() })
+    return(result)
+
+
+
+# ----------------------------------------------------------------------------
+# postprocess_slot
+# ----------------------------------------------------------------------------
+# Post-collection stage of a firewall: all files of the slot directory are
+# checked, compressed and hashed in parallel in the process pool (see
+# process_artifact), the hashes are written to SHA256SUMS and cached for
+# hash_file. Then the run report is written and the slot is moved to the
+# object store if configured. Files are only compressed and moved after a
+# successful backup, a failed one may still be resumed and must not replace
+# the manifest of the last complete backup in the slot. Returns success.
+#
+def postprocess_slot(job, success):
+    destdir = job["destdir"]
+    expected = {}
+    for record in job["report"]["phases"]:
+        if record.get("expected") is not None:
+            expected[record["file"]] = record["expected"]
+    compression = job["compression"] if success else None
+    with measure("postprocess", step="total"):
+        pool = get_process_pool()
+        futures = [ pool.submit(process_artifact, entry.path, compression, expected.get(entry.name))
+                    for entry in sorted(os.scandir(destdir), key=lambda e: e.name)
+                    if entry.is_file() and entry.name != "SHA256SUMS" ]
+        results = [ future.result() for future in futures ]
+    for result in results:
+        if result["error"]:
+            log(f"ERROR: Checking {result['error']}")
+            success = False
+        with FILE_HASHES_LOCK:
+            FILE_HASHES[os.path.join(destdir, result["file"])] = (
+                result["size"], result["mtime_ns"], result["sha256"])
+    compressed = sum(1 for r in results if compression and r["file"].endswith(COMPRESSION_SUFFIXES[compression]))
+    log(f"Checked {len(results)} files, compressed {compressed}.")
+    write_report(job, success)
+    try:
+        lines = [ f"{r['sha256']}  {r['file']}" for r in results ]
+        lines += [ f"{hash_file(os.path.join(destdir, f))}  {f}" for f in ("report.json", "report.prom")
+                   if os.path.isfile(os.path.join(destdir, f)) ]
+        with open(os.path.join(destdir, "SHA256SUMS"), 'w') as file:
+            file.write("\n".join(sorted(lines, key=lambda l: l[66:])) + "\n")
+    except Exception as e:
+        log(f"ERROR: Writing SHA256SUMS failed: {e}")
+        success = False
+    if job["storage"] == "objects" and not success:
+        log(f"Backup failed, keeping {destdir} out of the object store.")
+    elif job["storage"] == "objects":
+        try:
+            store_objects(job["fwdir"], job["slot"], job["dt"])
+            freed = collect_garbage(job["fwdir"])
+            log(f"Garbage collection freed {freed} bytes.")
+        except Exception as e:
+            log(f"ERROR: Storing objects of {job['destdir']} failed: {e}")
+            success = False
+    return(success)
+
+
+
+# ----------------------------------------------------------------------------
+# start_postprocess
+# ----------------------------------------------------------------------------
+# Run postprocess_slot of a firewall in the background, so the next firewall
+# is collected meanwhile. The log prefix and run report of the job are
+# passed on. The thread pool is created on first use like the process pool
+# (see get_process_pool). See wait_postprocess for the result.
+#
+POSTPROCESS_POOL = None
+POSTPROCESS_LOCK = threading.Lock()
+POSTPROCESS_FUTURES = {}
+
+def start_postprocess(job, success):
+    global POSTPROCESS_POOL
+    context = contextvars.copy_context()
+    with POSTPROCESS_LOCK:
+        if POSTPROCESS_POOL is None:
+            POSTPROCESS_POOL = ThreadPoolExecutor()
+        POSTPROCESS_FUTURES[job["fw"]] = POSTPROCESS_POOL.submit(context.run, postprocess_slot,
+                                                                 job, success)
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# wait_postprocess
+# ----------------------------------------------------------------------------
+# Wait until the post-collection stage of all firewalls has finished and
+# mark the job results of the firewalls where it failed as failed.
+#
+def wait_postprocess(results):
+    for result in results:
+        future = POSTPROCESS_FUTURES.get(result["firewall"])
+        if future is None:
+            continue
+        try:
+            success = future.result()
+        except Exception as e:
+            log(f"ERROR: Post-processing firewall {result['firewall']} failed: {e}")
+            success = False
+        result["success"] = result["success"] and success
+    if POSTPROCESS_POOL is not None:
+        POSTPROCESS_POOL.shutdown()
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# finish_firewall
+# ----------------------------------------------------------------------------
+# Store checksums and facts of a successful collection, verify the backup,
+# archive the configs and start the post-collection stage in the background
+# (see start_postprocess). Returns success of the collection.
+#
+def finish_firewall(job, success):
+    if job["receiver"]:
+        job["receiver"].unregister(job["destdir"])
+    if job["incremental"] and success and job["checksums"]:
+        write_checksums(job["fwdir"], job["slot"], job["checksums"], job["skipped"], job["journal"])
+    if job["facts_ttl"] and success:
+        save_facts(job["fwdir"], job["facts"])
+    with measure("verify", step="total"):
+        verify_backup(job["destdir"], job["failover_units"], job["contexts"],
+            job["diff_max_lines"], job["diff_mode"])
+    if success:
+        close_journal(job["journal"])
+    if job["history"] and success:
+        try:
+            archive_configs(job["fwdir"], job["destdir"], job["slot"], job["dt"])
+        except Exception as e:
+            log(f"ERROR: Archiving configs of {job['destdir']} failed: {e}")
+            success = False
+    start_postprocess(job, success)
+    return(success)
+
+
+
+# ----------------------------------------------------------------------------
+# backup_firewall
+# ----------------------------------------------------------------------------
+# Backup one firewall (HA pair). Returns True on success, False if the host
+# could not be reached or the backup failed.
+#
+def backup_firewall(cfg, fw):
+    job = prepare_firewall(cfg, fw)
+    if not job:
+        return(False)
+    REPORT.set(job["report"])
+    JOURNAL.set(job["journal"])
+    success = True
+    try:
+        collect_firewall(job)
+    except Exception as e:
+        log(f"ERROR: Backing up {job['hostname']} failed: {e}")
+        success = False
+    return(finish_firewall(job, success))
+
+
+
+# ----------------------------------------------------------------------------
+# AsyncASASession
+# ----------------------------------------------------------------------------
+# SSH session to an ASA for the asyncio engine, built on asyncssh. Opens an
+# interactive shell like Netmiko does, enters enable mode, disables paging
+# and sends commands, waiting for the prompt. Takes the same parameters as
+# ManagedConnection and retries failed commands on a new session the same
+# way, re-entering the last changeto contexts.
+#
+class AsyncASASession:
+
+    def __init__(self, params):
+        self.params = params
+        self.conn = None
+        self.process = None
+        self.prompt = None
+        self.session_log = None
+        self.changeto = {}
+
+    async def connect(self):
+        try:
+            import asyncssh
+        except ImportError:
+            raise RuntimeError("Python module asyncssh is required for the asyncio engine.")
+        params = self.params
+        client_keys = None
+        if params["use_keys"]:
+            client_keys = [ os.path.expanduser(params["key_file"]) ]
+        self.conn = await asyncssh.connect(params["host"], port=params["port"],
+            username=params["username"], password=params["password"],
+            client_keys=client_keys, known_hosts=None,
+            connect_timeout=params["conn_timeout"],
+            keepalive_interval=params.get("keepalive", 0))
+        log(f"SSH connection established to {params['host']}:{params['port']}.")
+        self.process = await self.conn.create_process(term_type="vt100",
+            term_size=(511, 24), encoding="utf-8", errors="replace")
+        if params.get("session_log"):
+            self.session_log = open(params["session_log"], 'a')
+        output = await self.read_until(re.compile(r'[>#] ?$'), params["conn_timeout"])
+        base_prompt = output.rstrip().split('\n')[-1].strip()[:-1].split('/')[0]
+        self.prompt = re.compile(r'(?:^|[\r\n])' + re.escape(base_prompt) + r'[^\r\n#>]*[#>] ?$')
+        if output.rstrip().endswith(">"):
+            self.process.stdin.write("enable\n")
+            await self.read_until(re.compile(r'[Pp]assword: ?$'), params["conn_timeout"])
+            self.process.stdin.write(params["secret"] + "\n")
+            await self.read_until(self.prompt, params["conn_timeout"])
+        await self.execute("terminal pager 0")
+        for command in self.changeto.values():
+            await self.execute(command)
+        return
+
+    async def read_until(self, pattern, timeout):
+        chunks = []
+        tail = ""
+        while True:
+            chunk = await asyncio.wait_for(self.process.stdout.read(65536), timeout)
+            if not chunk:
+                raise ConnectionError("SSH session closed by firewall.")
+            if self.session_log:
+                self.session_log.write(chunk)
+            chunks.append(chunk)
+            tail = (tail + chunk)[-512:]
+            if pattern.search(tail):
+                return("".join(chunks))
+
+    async def send_command(self, command):
+        retries = self.params.get("retries", 0)
+        delay = self.params.get("retry_delay", 5)
+        for attempt in range(retries + 1):
+            try:
+                if self.conn is None:
+                    await self.connect()
+                output = await self.execute(command)
+                break
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                log(f"WARNING: Connection to {self.params['host']} failed: {e}")
+                log(f"Reconnecting in {delay} seconds (attempt {attempt + 1} of {retries}) ...")
+                await self.close()
+                await asyncio.sleep(delay)
+                delay *= 2
+        if match := CHANGETO_PATTERN.match(command):
+            self.changeto[match.group(1) or ""] = command
+        return(output)
+
+    async def execute(self, command):
+        self.process.stdin.write(command + "\n")
+        output = await self.read_until(self.prompt, self.params["read_timeout_override"])
+        lines = output.replace('\r', '').split('\n')
+        return("\n".join(lines[1:-1]))
+
+    async def stream_command(self, command, file_path):
+        deadline = time.monotonic() + self.params["read_timeout_override"]
+        size = 0
+        pending = None
+        self.process.stdin.write(command + "\n")
+        with gzip.open(file_path, 'wt', encoding="utf-8") as file:
+            done = False
+            while not done:
+                timeout = deadline - time.monotonic()
+                chunk = await asyncio.wait_for(self.process.stdout.read(STREAM_BUFFER), timeout)
+                if not chunk:
+                    raise ConnectionError("SSH session closed by firewall.")
+                size += len(chunk)
+                pending, done = write_stream(file, pending, chunk, self.prompt)
+        log(f"Streamed {size} bytes to {os.path.basename(file_path)} ({os.path.getsize(file_path)} bytes compressed).")
+        return(size)
+
+    async def close(self):
+        if self.conn:
+            self.conn.close()
+            with contextlib.suppress(Exception):
+                await self.conn.wait_closed()
+            self.conn = None
+        if self.session_log:
+            self.session_log.close()
+            self.session_log = None
+        return
+
+
+
+# ----------------------------------------------------------------------------
+# run_batch_commands_async
+# ----------------------------------------------------------------------------
+# Same as run_batch_commands for the asyncio engine. Copied files are
+# hashed for the journal in a worker thread, backup archives can take
+# seconds and would stall the sessions of all other firewalls.
+#
+async def run_batch_commands_async(session, commands, unit="active", direct=False):
+    for command in commands:
+        with measure(**command_labels(command, unit)) as record:
+            output = await session.send_command(unit_command(command, unit, direct))
+            await asyncio.to_thread(record_copy, record, output)
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# run_steps_async
+# ----------------------------------------------------------------------------
+# Same as run_steps for the asyncio engine.
+#
+async def run_steps_async(session, steps):
+    output = None
+    try:
+        while True:
+            step = steps.send(output)
+            if isinstance(step, str):
+                output = await session.send_command(step)
+            else:
+                output = await run_batch_commands_async(session, *step)
+    except StopIteration as e:
+        return(e.value)
+
+
+
+# ----------------------------------------------------------------------------
+# collect_unit_async
+# ----------------------------------------------------------------------------
+# Same as collect_unit for the asyncio engine, with the same steps.
+#
+async def collect_unit_async(session, job, unit, ihack):
+    backup_url = job["backup_url"]
+    contexts = job["contexts"]
+    facts = job["facts"]
+    if job["tech_support_stream"]:
+        file = f"tech-support_{unit}.txt.gz"
+        if not is_done(file):
+            log(f"Streaming tech-support of {unit} unit ...")
+            with measure("tech-support", unit=unit, step="stream", file=file) as record:
+                record["bytes"] = await session.stream_command(unit_command("show tech-support", unit),
+                                                               os.path.join(job["destdir"], file))
+            await asyncio.to_thread(add_journal, unit, None, file)
+    else:
+        await run_steps_async(session, copy_tech_support_steps(unit, backup_url, ihack))
+    await run_steps_async(session, copy_config_steps(unit, backup_url, ihack, contexts,
+                                                     facts=facts))
+    await run_steps_async(session, run_backup_steps(unit, backup_url, ihack, contexts,
+                                                    job["passphrase"], facts=facts))
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# collect_firewall_async
+# ----------------------------------------------------------------------------
+# Same as collect_firewall for the asyncio engine. The options
+# standby-hostname, pipeline-depth and incremental are not supported, see
+# check_engine. Raises an exception if the collection failed.
+#
+async def collect_firewall_async(job):
+    session = AsyncASASession(job["cisco_asa"])
+    try:
+        with measure("connect", unit="active"):
+            await session.connect()
+        facts = job["facts"] = await run_steps_async(session, check_facts_steps(job["facts"]))
+        context_mode = await run_steps_async(session, query_fact_steps(facts, "context-mode"))
+        job["failover_units"] = await run_steps_async(session,
+                                                      query_fact_steps(facts, "failover-units"))
+        if context_mode == "multiple":
+            ihack = ""
+            await session.send_command("changeto system")
+            job["contexts"] = await run_steps_async(session, query_fact_steps(facts, "contexts"))
+        else:
+            ihack = parse_interface_hack(await session.send_command(INTERFACE_COMMAND))
+        if job["facts_ttl"] and "checksum" not in facts:
+            facts["checksum"] = parse_checksum(await session.send_command("show checksum"))
+        for unit in job["failover_units"]:
+            await collect_unit_async(session, job, unit, ihack)
+    finally:
+        await session.close()
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# backup_firewall_async
+# ----------------------------------------------------------------------------
+# Same as run_firewall_job for the asyncio engine. The preparation and the
+# verification run in threads, the collection runs in the event loop. The
+# semaphore limits the number of firewalls backed up at the same time, the
+# host semaphore the number uploading to the same backup host.
+#
+async def backup_firewall_async(cfg, fw, prefix, semaphore, host_semaphore):
+    async with host_semaphore, semaphore:
+        LOG_PREFIX.set(prefix)
+        start = time.monotonic()
+        success = False
+        try:
+            job = await asyncio.to_thread(prepare_firewall, cfg, fw)
+            if job:
+                REPORT.set(job["report"])
+                JOURNAL.set(job["journal"])
+                success = True
+                try:
+                    await collect_firewall_async(job)
+                except Exception as e:
+                    log(f"ERROR: Backing up {job['hostname']} failed: {e}")
+                    success = False
+                success = await asyncio.to_thread(finish_firewall, job, success)
+        except Exception as e:
+            log(f"ERROR: Backing up firewall {fw} failed: {e}")
+            success = False
+    result = {
+        "firewall": fw,
+        "success":  success,
+        "duration": time.monotonic() - start,
+    }
+    return(result)
+
+
+
+# ----------------------------------------------------------------------------
+# read_durations
+# ----------------------------------------------------------------------------
+# Read the durations in seconds of the last successful backups of a firewall
+# from durations.yaml in the firewall directory. Returns list, newest last.
+#
+DURATION_HISTORY = 7
+
+def read_durations(fwdir):
+    import yaml
+    try:
+        with open(os.path.join(fwdir, "durations.yaml"), 'r') as file:
+            return((yaml.safe_load(file) or {}).get("durations", []))
+    except FileNotFoundError:
+        return([])
+    except Exception as e:
+        log(f"WARNING: Reading durations failed: {e}")
+        return([])
+
+
+
+# ----------------------------------------------------------------------------
+# write_durations
+# ----------------------------------------------------------------------------
+# Add the durations of the successful backups of this run to durations.yaml
+# in the firewall directories, keeping the last DURATION_HISTORY of each.
+#
+def write_durations(cfg, results):
+    import yaml
+    for result in results:
+        if not result["success"]:
+            continue
+        fwdir = "/".join([cfg["firewalls"][result["firewall"]]["backup-dir"], result["firewall"]])
+        durations = read_durations(fwdir) + [ round(result["duration"], 1) ]
+        try:
+            file_path = os.path.join(fwdir, "durations.yaml")
+            with open(file_path + ".tmp", 'w') as file:
+                yaml.safe_dump({ "durations": durations[-DURATION_HISTORY:] }, file,
+                               default_flow_style=False)
+            os.replace(file_path + ".tmp", file_path)
+        except Exception as e:
+            log(f"WARNING: Writing durations of {result['firewall']} failed: {e}")
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# schedule_firewalls
+# ----------------------------------------------------------------------------
+# Order the firewalls longest processing time first: the firewall with the
+# longest expected backup is started first, so it does not run past the
+# maintenance window when started last. The expected duration is the median
+# of the last durations (see read_durations). Firewalls without history
+# come first, they may be large. Returns sorted list of firewalls.
+#
+def schedule_firewalls(cfg, firewalls):
+    expected = {}
+    for fw in firewalls:
+        durations = sorted(read_durations("/".join([cfg["firewalls"][fw]["backup-dir"], fw])))
+        expected[fw] = durations[len(durations) // 2] if durations else float("inf")
+    return(sorted(firewalls, key=lambda fw: (-expected[fw], fw)))
+
+
+
+# ----------------------------------------------------------------------------
+# get_host_limits
+# ----------------------------------------------------------------------------
+# Returns dict backup-host -> maximum number of firewalls backed up to it at
+# the same time, set with backup-host-jobs (0 or unset is unlimited). If the
+# firewalls of one backup host have different limits, the lowest applies.
+#
+def get_host_limits(cfg, firewalls):
+    limits = {}
+    for fw in firewalls:
+        host = cfg["firewalls"][fw].backup_host
+        limit = cfg["firewalls"][fw].backup_host_jobs
+        if limit and (not limits.get(host) or limit < limits[host]):
+            limits[host] = limit
+        else:
+            limits.setdefault(host, 0)
+    return(limits)
+
+
+
+# ----------------------------------------------------------------------------
+# find_latest_slot
+# ----------------------------------------------------------------------------
+# Returns tuple of the most recent slot of a firewall and its date, taken
+# from the slot directories and the manifests of the object store, or
+# (None, None) if there is no backup.
+#
+def find_latest_slot(fwdir):
+    slots = {}
+    if os.path.isdir(fwdir):
+        for entry in os.scandir(fwdir):
+            if entry.is_dir() and re.match(r'(daily|monthly|yearly)_\d+$', entry.name):
+                slots[entry.name] = datetime.fromtimestamp(entry.stat().st_mtime)
+    manifests = os.path.join(fwdir, "manifests")
+    if os.path.isdir(manifests):
+        for entry in os.scandir(manifests):
+            if entry.name.endswith(".json") and entry.name[:-5] not in slots:
+                manifest = read_manifest(fwdir, entry.name[:-5])
+                slots[entry.name[:-5]] = datetime.strptime(manifest["date"], "%Y-%m-%d %H:%M:%S")
+    if not slots:
+        return(None, None)
+    slot = max(slots, key=slots.get)
+    return(slot, slots[slot])
+
+
+
+# ----------------------------------------------------------------------------
+# list_firewalls
+# ----------------------------------------------------------------------------
+# Print the firewalls with host, backup host, latest backup and median
+# duration of the last backups. Reads only the backup directories.
+#
+def list_firewalls(cfg, firewalls):
+    width = max(len(fw) for fw in list(firewalls) + [ "Firewall" ])
+    log(f"{'Firewall':<{width}}  {'Host':<30}  {'Backup host':<20}  {'Latest backup':<30}  Duration")
+    log("=" * 80)
+    for fw in sorted(firewalls):
+        fwdir = "/".join([cfg["firewalls"][fw]["backup-dir"], fw])
+        slot, dt = find_latest_slot(fwdir)
+        latest = f"{dt.strftime('%Y-%m-%d %H:%M')} {slot}" if slot else "none"
+        durations = sorted(read_durations(fwdir))
+        duration = "unknown"
+        if durations:
+            minutes, seconds = divmod(int(durations[len(durations) // 2]), 60)
+            duration = f"{minutes // 60:02d}:{minutes % 60:02d}:{seconds:02d}"
+        log(f"{fw:<{width}}  {cfg['firewalls'][fw]['hostname']:<30}  "
+            f"{cfg['firewalls'][fw]['backup-host']:<20}  {latest:<30}  {duration}")
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# verify_slot
+# ----------------------------------------------------------------------------
+# Verify an existing backup like after a backup run (see verify_backup),
+# without connecting to the firewall. The failover units and contexts are
+# taken from the config files of the slot. A slot in the object store is
+# restored to a temporary directory first. Uses the latest slot if slot is
+# None. Returns True if all configs are equal.
+#
+def verify_slot(cfg, fw, slot=None):
+    fwdir = "/".join([cfg["firewalls"][fw]["backup-dir"], fw])
+    slot = slot or find_latest_slot(fwdir)[0]
+    if not slot:
+        log(f"ERROR: No backup of {fw} in {fwdir}.")
+        return(False)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        destdir = os.path.join(fwdir, slot)
+        if not os.path.isdir(destdir):
+            destdir = tmpdir
+            if not restore_slot(fwdir, slot, destdir):
+                return(False)
+        files = os.listdir(destdir)
+        failover_units = [ "active" ]
+        if "running-config_standby.cfg" in files:
+            failover_units.append("standby")
+        contexts = sorted(m.group(1) for f in files if (m := re.match(r'context_(.+)_active\.cfg$', f)))
+        results = verify_backup(destdir, failover_units, contexts,
+            cfg["firewalls"][fw].diff_max_lines, cfg["firewalls"][fw].diff_mode)
+    equal = sum(1 for r in results if r["equal"])
+    log(f"Verified slot {slot}: {equal} of {len(results)} config pairs equal.")
+    return(equal == len(results))
+
+
+
+# ----------------------------------------------------------------------------
+# dry_run
+# ----------------------------------------------------------------------------
+# Print what a backup run would do without connecting to any firewall: the
+# order the firewalls are started in (see schedule_firewalls), their backup
+# directory, options and the commands sent to each unit. The commands need
+# the cached device facts (see facts-ttl), regardless of their age, and do
+# not include the interface hack. Passwords are masked.
+#
+DRY_RUN_OPTIONS = ( "standby-hostname", "pipeline-depth", "incremental", "storage",
+    "facts-ttl", "receiver", "tech-support-stream", "retries", "history",
+    "compression", "diff-mode", "backup-host-jobs", "resume" )
+
+def dry_run(cfg, firewalls, jobs=1, engine="netmiko"):
+    firewalls = schedule_firewalls(cfg, firewalls)
+    log(f"Backup of {len(firewalls)} firewalls with {jobs} jobs, engine {engine}.")
+    for fw in firewalls:
+        fwcfg = cfg["firewalls"][fw]
+        fwdir = "/".join([fwcfg["backup-dir"], fw])
+        destdir = "/".join([fwdir, get_retention_slot(datetime.now())])
+        backup_url = f"scp://{fwcfg['backup-username']}:****@{fwcfg['backup-host']}/{destdir}"
+        durations = sorted(read_durations(fwdir))
+        log("")
+        log("=" * 80)
+        log("Firewall name   : {}".format(fw))
+        log("Firewall host   : {}:{}".format(fwcfg.hostname, fwcfg.port))
+        log("Backup host     : {}".format(fwcfg["backup-host"]))
+        log("Backup directory: {}".format(destdir))
+        log("Expected time   : {}".format(f"{durations[len(durations) // 2]:.0f} seconds" if durations else "unknown"))
+        log("Options         : {}".format(", ".join(f"{k}={fwcfg[k]}" for k in DRY_RUN_OPTIONS
+                                                     if fwcfg[k] != CONFIG_OPTIONS[k][1]) or "none"))
+        log("=" * 80)
+        facts = load_facts(fwdir, float("inf"))
+        if not facts.get("failover-units"):
+            log("No cached device facts, commands are only known after discovery.")
+            continue
+        contexts = facts.get("contexts", []) if facts.get("context-mode") == "multiple" else []
+        config_urls = [ (c, facts.get("config-urls", {}).get(c, f"<config-url of {c}>")) for c in contexts ]
+        for unit in facts["failover-units"]:
+            commands = [ "show tech-support" ] if fwcfg.tech_support_stream else \
+                tech_support_commands(unit, backup_url, "")
+            commands += config_commands(unit, backup_url, "", config_urls)
+            for context in ([ "system" ] + contexts if contexts else [ None ]):
+                commands += backup_commands(context, unit, backup_url, "", "****")[1]
+            for command in commands:
+                log(f"{unit:<8}  {unit_command(command, unit)}")
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# run_firewall_job
+# ----------------------------------------------------------------------------
+# Worker for the job pool. Runs backup_firewall for one firewall with its own
+# log prefix and measures the duration. Never raises, a failed backup is
+# reported in the returned dict with firewall, success and duration.
+#
+def run_firewall_job(cfg, fw, prefix=""):
+    LOG_PREFIX.set(prefix)
+    start = time.monotonic()
+    try:
+        success = backup_firewall(cfg, fw)
+    except Exception as e:
+        log(f"ERROR: Backing up firewall {fw} failed: {e}")
+        success = False
+    result = {
+        "firewall": fw,
+        "success":  success,
+        "duration": time.monotonic() - start,
+    }
+    return(result)
+
+
+
+# ----------------------------------------------------------------------------
+# run_firewall_jobs
+# ----------------------------------------------------------------------------
+# Backup the firewalls with a bounded pool of worker threads. Netmiko spends
+# most of the time waiting for the firewall, so threads are sufficient. The
+# firewalls are started in the given order (see schedule_firewalls), a
+# firewall is passed over while its backup host has reached its limit (see
+# get_host_limits) and started as soon as a job on that host has finished.
+# With more than one job each output line is prefixed with the firewall name.
+# Returns list of job results in the order of the firewalls.
+#
+def run_firewall_jobs(cfg, firewalls, jobs=1):
+    width = max(len(fw) for fw in firewalls)
+    limits = get_host_limits(cfg, firewalls)
+    hosts = { host: 0 for host in limits }
+    pending = list(firewalls)
+    running = {}
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        while pending or running:
+            for fw in list(pending):
+                if len(running) >= max(1, jobs):
+                    break
+                host = cfg["firewalls"][fw]["backup-host"]
+                if limits[host] and hosts[host] >= limits[host]:
+                    continue
+                prefix = f"{fw:<{width}} | " if jobs > 1 else ""
+                running[pool.submit(run_firewall_job, cfg, fw, prefix)] = host
+                hosts[host] += 1
+                pending.remove(fw)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                hosts[running.pop(future)] -= 1
+                result = future.result()
+                results[result["firewall"]] = result
+    return([results[fw] for fw in firewalls])
+
+
+
+# ----------------------------------------------------------------------------
+# run_firewall_jobs_async
+# ----------------------------------------------------------------------------
+# Backup the firewalls with the asyncio engine in one event loop, at most
+# jobs at the same time and at most the limit of each backup host (see
+# get_host_limits). The semaphores wake up waiting firewalls in the given
+# order. Returns list of job results like run_firewall_jobs.
+#
+async def run_firewall_jobs_async(cfg, firewalls, jobs=1):
+    width = max(len(fw) for fw in firewalls)
+    semaphore = asyncio.Semaphore(max(1, jobs))
+    host_semaphores = { host: asyncio.Semaphore(limit or len(firewalls))
+                        for host, limit in get_host_limits(cfg, firewalls).items() }
+    tasks = []
+    for fw in firewalls:
+        prefix = f"{fw:<{width}} | " if jobs > 1 else ""
+        host_semaphore = host_semaphores[cfg["firewalls"][fw]["backup-host"]]
+        tasks.append(backup_firewall_async(cfg, fw, prefix, semaphore, host_semaphore))
+    results = await asyncio.gather(*tasks)
+    return(list(results))
+
+
+
+# ----------------------------------------------------------------------------
+# print_summary
+# ----------------------------------------------------------------------------
+# Print a table with the result and duration of each firewall backup.
+#
+def print_summary(results):
+    width = max([len(r["firewall"]) for r in results] + [len("Firewall")])
+    log("")
+    log("=" * 80)
+    log(f"{'Firewall':<{width}}  Result   Duration")
+    log("-" * 80)
+    for r in results:
+        status = "OK" if r["success"] else "FAILED"
+        minutes, seconds = divmod(int(r["duration"]), 60)
+        hours, minutes = divmod(minutes, 60)
+        log(f"{r['firewall']:<{width}}  {status:<7}  {hours:02d}:{minutes:02d}:{seconds:02d}")
+    log("=" * 80)
+    return
+
+
+
+# -----------------------------------------------------------------------------
+# get_arguments
+# -----------------------------------------------------------------------------
+# Read commandline arguments. Returns a Namespace object with all the given
+# arguments.
+#
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Update object-groups on the Cisco firewalls.")
+    parser.add_argument('command', nargs='?', default="backup",
+        choices=[ "backup", "restore", "export", "gc", "query", "search",
+        "verify", "list", "dry-run" ], help="""Backup the firewalls
+        (default), restore or export a slot directory from the object store,
+        remove unreferenced objects, print a config from the config history
+        or search lines in it, verify the latest or given slot, list the
+        firewalls with their latest backup or show what a backup would do.
+        Only backup connects to the firewalls.""")
+    parser.add_argument('-c', '--config', required=False, 
+        metavar="FILENAME", help="Configuration file in YAML format.")
+    parser.add_argument('-f', '--firewalls', required=True, nargs='+',
+        metavar="NAME", help="""Select firewalls (HA pairs) to be updated as
+        listed in the YAML config file. If not used or set to 'all', all 
+        configured firewalls are backed up.""")
+    parser.add_argument('-j', '--jobs', required=False, type=int, default=1,
+        metavar="N", help="""Number of firewalls to backup concurrently.
+        Defaults to 1.""")
+    parser.add_argument('-e', '--engine', required=False, default="netmiko",
+        choices=[ "netmiko", "asyncio" ], help="""Engine for the SSH sessions.
+        Netmiko (default) uses one thread per job. Asyncio drives all jobs
+        in one thread and requires Python module asyncssh.""")
+    parser.add_argument('-r', '--resume', action='store_true', help="""Resume
+        an interrupted backup of the same day. Files already completed
+        according to the journal in the slot directory are not collected
+        again.""")
+    parser.add_argument('-s', '--slot', required=False, metavar="SLOT",
+        help="""Slot to restore, export or verify, e. g. daily_3 or
+        yearly_2024.""")
+    parser.add_argument('-o', '--output', required=False, metavar="DIR",
+        help="Destination directory for export.")
+    parser.add_argument('--file', required=False, metavar="FILENAME",
+        help="""Config file to query, e. g. context_web1_active.cfg. Without
+        it, query lists the files in the config history.""")
+    parser.add_argument('--at', required=False, metavar="TIME",
+        help="""Query the config as it was at this time (YYYY-MM-DD HH:MM:SS
+        or a prefix of it). Defaults to the latest version.""")
+    parser.add_argument('-p', '--pattern', required=False, metavar="TEXT",
+        help="Text to search for in the config history.")
+    args = parser.parse_args()
+    if args.command in ("restore", "export") and not args.slot:
+        parser.error(f"{args.command} requires --slot")
+    if args.command == "export" and not args.output:
+        parser.error("export requires --output")
+    if args.command == "search" and not args.pattern:
+        parser.error("search requires --pattern")
+    return(args)
+
+
+
+# ----------------------------------------------------------------------------
+# MAIN 
+# ----------------------------------------------------------------------------
+# Read commandline arguments, configuration file and backup the firewalls
+# given as argument or in configuration file. Exits with status 1 if the
+# backup of any firewall failed.
+#
+if __name__ == "__main__":
+    write_default_config_file()
+    args = get_arguments()
+    cfg = read_configfile(args.config)    
+    firewalls = validate_firewalls(cfg, args.firewalls)
+    if args.command in ("backup", "dry-run"):
+        check_engine(cfg, firewalls, args.engine)
+    if args.command == "list":
+        list_firewalls(cfg, firewalls)
+        sys.exit(0)
+    if args.command == "dry-run":
+        dry_run(cfg, firewalls, args.jobs, args.engine)
+        sys.exit(0)
+    if args.command in ("restore", "export", "gc", "query", "search", "verify"):
+        success = True
+        for fw in firewalls:
+            fwdir = "/".join([cfg["firewalls"][fw]["backup-dir"], fw])
+            if len(firewalls) > 1:
+                LOG_PREFIX.set(f"{fw} | ")
+            if args.command == "verify":
+                success = verify_slot(cfg, fw, args.slot) and success
+                continue
+            if args.command == "query":
+                success = query_history(fwdir, args.file, args.at) and success
+                continue
+            if args.command == "search":
+                search_history(fwdir, args.pattern)
+                continue
+            if args.command == "gc":
+                log(f"Garbage collection freed {collect_garbage(fwdir)} bytes in {fwdir}.")
+                continue
+            outdir = os.path.join(fwdir, args.slot)
+            if args.command == "export":
+                outdir = os.path.join(args.output, fw, args.slot) if len(firewalls) > 1 else args.output
+            success = restore_slot(fwdir, args.slot, outdir) and success
+        sys.exit(0 if success else 1)
+    preflight_firewalls(cfg, firewalls)
+    firewalls = schedule_firewalls(cfg, firewalls)
+    if args.resume:
+        for fw in firewalls:
+            cfg["firewalls"][fw]["resume"] = True
+    RECEIVER = start_receiver(cfg, firewalls)
+    if args.engine == "asyncio":
+        import asyncio
+        results = asyncio.run(run_firewall_jobs_async(cfg, firewalls, args.jobs))
+    else:
+        results = run_firewall_jobs(cfg, firewalls, args.jobs)
+    if RECEIVER:
+        RECEIVER.stop()
+    wait_postprocess(results)
+    if PROCESS_POOL:
+        PROCESS_POOL.shutdown()
+    write_durations(cfg, results)
+    print_summary(results)
+    if not all(r["success"] for r in results):
+        sys.exit(1)
@@ -0,0 +1,515 @@
+#!/usr/bin/env python3.11
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------------------------
+# Benchmark of asa_backup.py against simulated Cisco ASA firewalls.
+# ----------------------------------------------------------------------------
+#
+# Starts a process with N fake ASA SSH servers on 127.0.0.1 (one port per
+# firewall), writes a config file for them and runs the full backup with
+# asa_backup.py in a subprocess. Reports wall-clock time, throughput, time
+# per firewall (from report.json of every slot) and peak memory.
+#
+# The fake ASA answers the commands used by asa_backup.py with configurable
+# latency, number of contexts and artifact sizes. Copies to scp:// URLs are
+# simulated by writing the file directly to the path of the URL at the
+# configured bandwidth, so no sshd is needed on the backup host.
+#
+# Example:
+#
+#     benchmarks/asa_benchmark.py -n 50 -j 10 --contexts 5 --latency 0.05
+#     benchmarks/asa_benchmark.py -n 20 -j 20 -e asyncio -o tech-support-stream=True
+#
+# Requires paramiko (fake SSH servers) and everything asa_backup.py needs.
+# The preflight check connects to the fake SSH servers on 127.0.0.1.
+
+
+
+# ----------------------------------------------------------------------------
+# Import Libraries
+# ----------------------------------------------------------------------------
+
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import yaml
+
+import paramiko
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "asa_backup.py")
+
+
+
+# ----------------------------------------------------------------------------
+# FakeASA
+# ----------------------------------------------------------------------------
+# Command line of one simulated ASA unit pair. Keeps the current context,
+# enable and config mode and the files on flash. Commands for the standby
+# unit ("failover exec standby") get the same answers as the active unit.
+# The standby unit has management address 127.0.0.2 in "show failover", the
+# fake listens there too (for standby-hostname auto).
+#
+class FakeASA:
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.settings = settings
+        self.contexts = [ f"ctx{i}" for i in range(1, settings["contexts"]) ]
+        if settings["contexts"]:
+            self.contexts.insert(0, "admin")
+        self.context = "admin" if self.contexts else None
+        self.enabled = False
+        self.config_mode = False
+        self.flash = {}
+
+    def prompt(self):
+        prompt = self.name
+        if self.context and self.context != "system":
+            prompt += "/" + self.context
+        if self.config_mode:
+            prompt += "(config)"
+        return(prompt + ("#" if self.enabled else ">") + " ")
+
+    def config_text(self, context):
+        lines = [ f"hostname {self.name}", "!", f"! context {context}", "!" ]
+        for i in range(self.settings["config_lines"]):
+            lines.append(f"access-list ACL-{i // 100} extended permit tcp any host "
+                         f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256} eq 443")
+        digest = hashlib.md5("\n".join(lines).encode()).hexdigest()
+        lines.append(f"Cryptochecksum:{digest}")
+        return("\n".join(lines) + "\n")
+
+    def failover_text(self):
+        if not self.settings["failover"]:
+            return("Failover Off")
+        context = "admin " if self.contexts else ""
+        lines = [ "Failover On", "Failover unit Primary",
+                  "Failover LAN Interface: folink GigabitEthernet0/3 (up)",
+                  "Version: Ours 9.16(3)23, Mate 9.16(3)23" ]
+        for host, unit, state, last in (("This host", "Primary", "Active", 1),
+                                         ("Other host", "Secondary", "Standby Ready", 2)):
+            lines += [ f"        {host}: {unit} - {state}",
+                       "                Active time: 86400 (sec)",
+                       f"                  {context}Interface management (127.0.0.{last}): Normal (Monitored)",
+                       f"                  {context}Interface inside (10.0.0.{last}): Normal (Monitored)" ]
+        lines += [ "", "Stateful Failover Logical Update Statistics" ]
+        return("\n".join(lines))
+
+    def write_file(self, url, size=None, text=None):
+        match = re.match(r'scp://[^@]+@[^/]+(/.+?)(;int=\S+)?$', url)
+        if not match:
+            return("%Error opening " + url)
+        data = text.encode() if text is not None else None
+        length = len(data) if data is not None else size
+        time.sleep(length / (self.settings["bandwidth"] * 1024 * 1024))
+        with open(match.group(1), 'wb') as file:
+            if data is not None:
+                file.write(data)
+            else:
+                block = (self.name.encode() + b" ") * 8192
+                archive = file
+                if match.group(1).endswith(".gz"):
+                    archive = gzip.GzipFile(fileobj=file, mode='wb', compresslevel=0)
+                while size > 0:
+                    archive.write(block[:size])
+                    size -= min(size, len(block))
+                if archive is not file:
+                    archive.close()
+        length = os.path.getsize(match.group(1))
+        return(f"{length} bytes copied in 0.10 secs")
+
+    def handle(self, line):
+        time.sleep(self.settings["latency"])
+        command = re.sub(r'^failover exec (active|standby|mate) ', '', line.strip())
+        words = command.split()
+        if not words or command.startswith("terminal") or command == "show curpriv":
+            return("")
+        if command in ("configure terminal", "conf t"):
+            self.config_mode = True
+            return("")
+        if command in ("end", "exit"):
+            self.config_mode = False
+            return("")
+        if command.startswith("show mode"):
+            return(f"Security context mode: {'multiple' if self.contexts else 'single'}")
+        if command.startswith("show failover"):
+            return(self.failover_text())
+        if command.startswith("show version"):
+            return("Cisco Adaptive Security Appliance Software Version 9.16(3)23")
+        if command.startswith("show context"):
+            lines = [ "Context Name      Class      Interfaces           Mode         URL" ]
+            for context in self.contexts:
+                marker = "*" if context == "admin" else " "
+                lines.append(f"{marker}{context:<16} default    GigabitEthernet0/0   Routed       disk0:/{context}.cfg")
+            lines.append(f"Total active Security Contexts: {len(self.contexts)}")
+            return("\n".join(lines))
+        if command.startswith("show run context"):
+            return(f"  config-url disk0:/{words[3]}.cfg")
+        if command.startswith("changeto"):
+            self.context = words[-1]
+            return("")
+        if command.startswith("show checksum"):
+            digest = hashlib.md5(f"{self.name}/{self.context}".encode()).hexdigest()
+            return("Cryptochecksum: " + " ".join(digest[i:i + 8] for i in range(0, 32, 8)))
+        if command.startswith("show interface"):
+            return('Interface GigabitEthernet0/1 "inside", is up, line protocol is up')
+        if command.startswith("show tech-support file"):
+            self.flash[words[-1].split("/")[-1]] = self.settings["tech_support_size"]
+            return("")
+        if command.startswith("backup"):
+            time.sleep(self.settings["backup_time"])
+            self.flash[words[-1].split("/")[-1]] = self.settings["archive_size"]
+            return("Backup succeeded")
+        if command.startswith("copy"):
+            source, url = words[-2], words[-1]
+            if source in ("running-config", "startup-config"):
+                return(self.write_file(url, text=self.config_text("system")))
+            if source.startswith("disk0:/"):
+                return(self.write_file(url, text=self.config_text(source[7:-4])))
+            file = source.split("/")[-1]
+            if file not in self.flash:
+                return(f"%Error opening {source} (No such file or directory)")
+            return(self.write_file(url, size=self.flash[file]))
+        if command.startswith("delete"):
+            self.flash.pop(words[-1].split("/")[-1], None)
+            return("")
+        return("ERROR: % Invalid input detected at '^' marker.")
+
+    def tech_support(self, channel):
+        line = "tech-support output of simulated firewall " + self.name + "\r\n"
+        chunk = line * (65536 // len(line))
+        remaining = self.settings["tech_support_size"]
+        while remaining > 0:
+            channel.sendall(chunk[:remaining])
+            remaining -= len(chunk)
+        return
+
+
+
+# ----------------------------------------------------------------------------
+# FakeServer
+# ----------------------------------------------------------------------------
+# Paramiko server interface of a fake ASA. Accepts any password and opens
+# an interactive shell.
+#
+class FakeServer(paramiko.ServerInterface):
+
+    def __init__(self):
+        self.shell = threading.Event()
+
+    def get_allowed_auths(self, username):
+        return("password")
+
+    def check_auth_password(self, username, password):
+        return(paramiko.AUTH_SUCCESSFUL)
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return(paramiko.OPEN_SUCCEEDED)
+        return(paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED)
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth,
+                                  pixelheight, modes):
+        return(True)
+
+    def check_channel_shell_request(self, channel):
+        self.shell.set()
+        return(True)
+
+
+
+# ----------------------------------------------------------------------------
+# run_shell
+# ----------------------------------------------------------------------------
+# Interactive shell of a fake ASA session: echo every line, answer it and
+# print the prompt, like the ASA does.
+#
+def run_shell(channel, asa):
+    channel.sendall("\r\nType help or '?' for a list of available commands.\r\n" + asa.prompt())
+    buffer = ""
+    password = False
+    while data := channel.recv(4096):
+        buffer += data.decode(errors="replace").replace("\r\n", "\n").replace("\r", "\n")
+        while "\n" in buffer:
+            line, buffer = buffer.split("\n", 1)
+            if password:
+                password = False
+                asa.enabled = True
+                channel.sendall("\r\n" + asa.prompt())
+            elif line.strip() == "enable":
+                password = True
+                channel.sendall(line + "\r\nPassword: ")
+            elif re.sub(r'^failover exec \S+ ', '', line.strip()) == "show tech-support":
+                channel.sendall(line + "\r\n")
+                asa.tech_support(channel)
+                channel.sendall("\r\n" + asa.prompt())
+            else:
+                output = asa.handle(line)
+                if output:
+                    output = output.replace("\n", "\r\n") + "\r\n"
+                channel.sendall(line + "\r\n" + output + asa.prompt())
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# handle_connection
+# ----------------------------------------------------------------------------
+# SSH connection to a fake ASA. Every session gets its own command line
+# state, like a new SSH session to a real firewall.
+#
+def handle_connection(client, name, settings, host_key):
+    transport = paramiko.Transport(client)
+    try:
+        transport.add_server_key(host_key)
+        server = FakeServer()
+        transport.start_server(server=server)
+        channel = transport.accept(30)
+        if channel and server.shell.wait(30):
+            run_shell(channel, FakeASA(name, settings))
+            channel.close()
+    except Exception:
+        pass
+    finally:
+        transport.close()
+    return
+
+
+
+# ----------------------------------------------------------------------------
+# serve_devices
+# ----------------------------------------------------------------------------
+# Run the fake ASA SSH servers, one per port. Runs in its own process until
+# terminated, so its memory and CPU are not counted for the backup.
+#
+def serve_devices(devices, settings, ready):
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    host_key = paramiko.RSAKey.generate(2048)
+    addresses = [ "127.0.0.1", "127.0.0.2" ] if settings["failover"] else [ "127.0.0.1" ]
+    for name, port in devices:
+        for address in addresses:
+            sock = socket.create_server((address, port), backlog=64)
+
+            def accept(sock=sock, name=name):
+                while True:
+                    client, address = sock.accept()
+                    threading.Thread(target=handle_connection, daemon=True,
+                                     args=(client, name, settings, host_key)).start()
+
+            threading.Thread(target=accept, daemon=True).start()
+    ready.set()
+    while True:
+        time.sleep(3600)
+
+
+
+# ----------------------------------------------------------------------------
+# write_config
+# ----------------------------------------------------------------------------
+# Write the asa_backup config file for the simulated firewalls to home.
+# Options are key=value settings added to the defaults. Returns list of
+# (name, port) of the firewalls.
+#
+def write_config(home, backup_dir, count, base_port, options):
+    defaults = {
+        "device-type":     "cisco_asa",
+        "conn-timeout":    30,
+        "read-timeout":    600,
+        "username":        "bench",
+        "password":        "bench",
+        "use-key":         False,
+        "ssh-key":         "~/.ssh/id_rsa",
+        "backup-host":     "127.0.0.1",
+        "backup-username": "bench",
+        "backup-password": "bench",
+        "backup-dir":      backup_dir,
+    }
+    for option in options:
+        key, value = option.split("=", 1)
+        defaults[key] = yaml.safe_load(value)
+    # Netmiko passes the key file to paramiko even if use-key is False.
+    os.makedirs(os.path.join(home, ".ssh"), mode=0o700)
+    paramiko.ECDSAKey.generate().write_private_key_file(os.path.join(home, ".ssh", "id_rsa"))
+    devices = [ (f"bench{i:03d}", base_port + i) for i in range(1, count + 1) ]
+    cfg = {
+        "defaults":  defaults,
+        "firewalls": { name: { "hostname": "127.0.0.1", "port": port, "enable-secret": "bench" }
+                       for name, port in devices },
+    }
+    with open(os.path.join(home, ".asa_backup.yaml"), 'w') as file:
+        yaml.safe_dump(cfg, file)
+    return(devices)
+
+
+
+# ----------------------------------------------------------------------------
+# run_backup
+# ----------------------------------------------------------------------------
+# Run asa_backup.py for all firewalls with HOME set to home. The output is
+# written to backup.log in home. Returns tuple (exit status, seconds, peak
+# RSS in kB of the backup process).
+#
+def run_backup(home, jobs, engine):
+    env = dict(os.environ, HOME=home)
+    command = [ sys.executable, SCRIPT, "-f", "all", "-j", str(jobs), "-e", engine ]
+    with open(os.path.join(home, "backup.log"), 'w') as log:
+        start = time.monotonic()
+        process = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+        pid, status, rusage = os.wait4(process.pid, 0)
+        seconds = time.monotonic() - start
+    return(os.waitstatus_to_exitcode(status), seconds, rusage.ru_maxrss)
+
+
+
+# ----------------------------------------------------------------------------
+# read_reports
+# ----------------------------------------------------------------------------
+# Read report.json of every slot in the backup directory. Slots moved to the
+# object store have their report as object, found through the manifest.
+# Returns list of reports.
+#
+def read_reports(backup_dir):
+    reports = []
+    for file_path in glob.glob(os.path.join(backup_dir, "*", "*", "report.json")):
+        with open(file_path, 'r') as file:
+            reports.append(json.load(file))
+    for file_path in glob.glob(os.path.join(backup_dir, "*", "manifests", "*.json")):
+        with open(file_path, 'r') as file:
+            manifest = json.load(file)
+        if "report.json" in manifest["files"]:
+            digest = manifest["files"]["report.json"]["sha256"]
+            fwdir = os.path.dirname(os.path.dirname(file_path))
+            with open(os.path.join(fwdir, "objects", digest[:2], digest[2:]), 'r') as file:
+                reports.append(json.load(file))
+    return(reports)
+
+
+
+# ----------------------------------------------------------------------------
+# print_results
+# ----------------------------------------------------------------------------
+# Print wall-clock time, throughput, time per firewall, the slowest phases
+# and peak memory of a benchmark run.
+#
+def print_results(args, status, seconds, maxrss, reports, backup_dir):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(backup_dir):
+        total += sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+    durations = sorted(r["seconds"] for r in reports)
+    phases = {}
+    for report in reports:
+        for record in report["phases"]:
+            key = (record["phase"], record.get("step"))
+            phases[key] = phases.get(key, 0.0) + record["seconds"]
+    print("=" * 80)
+    print(f"Firewalls       : {args.firewalls} ({len(reports)} reports, "
+          f"{sum(1 for r in reports if r['success'])} successful)")
+    print(f"Jobs / engine   : {args.jobs} / {args.engine}")
+    print(f"Exit status     : {status}")
+    print(f"Wall-clock time : {seconds:.2f} s")
+    print(f"Throughput      : {args.firewalls / seconds * 60:.1f} firewalls/min, "
+          f"{total / seconds / 1024 / 1024:.2f} MB/s ({total} bytes)")
+    if durations:
+        print(f"Time/firewall   : min {durations[0]:.2f} s, "
+              f"median {durations[len(durations) // 2]:.2f} s, max {durations[-1]:.2f} s")
+    print(f"Peak memory     : {maxrss / 1024:.1f} MB")
+    print("-" * 80)
+    print("Slowest phases (sum over all firewalls):")
+    for (phase, step), secs in sorted(phases.items(), key=lambda x: -x[1])[:8]:
+        print(f"  {phase:<14} {step or '':<16} {secs:10.2f} s")
+    print("=" * 80)
+    return
+
+
+
+# -----------------------------------------------------------------------------
+# get_arguments
+# -----------------------------------------------------------------------------
+# Read commandline arguments. Returns a Namespace object with all the given
+# arguments.
+#
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark asa_backup.py against simulated ASA firewalls.")
+    parser.add_argument('-n', '--firewalls', type=int, default=10, metavar="N",
+        help="Number of simulated firewalls. Defaults to 10.")
+    parser.add_argument('-j', '--jobs', type=int, default=None, metavar="N",
+        help="Jobs for asa_backup.py. Defaults to number of firewalls.")
+    parser.add_argument('-e', '--engine', default="netmiko", choices=[ "netmiko", "asyncio" ],
+        help="Engine for asa_backup.py. Defaults to netmiko.")
+    parser.add_argument('-o', '--option', action='append', default=[], metavar="KEY=VALUE",
+        help="Setting added to the defaults of the config, e. g. incremental=True.")
+    parser.add_argument('--contexts', type=int, default=3, metavar="N",
+        help="Contexts per firewall, 0 for single context mode. Defaults to 3.")
+    parser.add_argument('--no-failover', action='store_true',
+        help="Simulate firewalls without standby unit.")
+    parser.add_argument('--latency', type=float, default=0.05, metavar="SECONDS",
+        help="Latency of every command. Defaults to 0.05.")
+    parser.add_argument('--backup-time', type=float, default=0.5, metavar="SECONDS",
+        help="Duration of a backup command. Defaults to 0.5.")
+    parser.add_argument('--bandwidth', type=float, default=50, metavar="MB/S",
+        help="Bandwidth of a copy to the backup host. Defaults to 50.")
+    parser.add_argument('--archive-size', type=int, default=1024, metavar="KB",
+        help="Size of a backup archive. Defaults to 1024.")
+    parser.add_argument('--tech-support-size', type=int, default=512, metavar="KB",
+        help="Size of the tech-support. Defaults to 512.")
+    parser.add_argument('--config-lines', type=int, default=2000, metavar="N",
+        help="Lines of a config. Defaults to 2000.")
+    parser.add_argument('--port', type=int, default=20000, metavar="PORT",
+        help="Base port of the fake firewalls. Defaults to 20000.")
+    parser.add_argument('--keep', action='store_true',
+        help="Keep the temporary directory with backups and log.")
+    return(parser.parse_args())
+
+
+
+# ----------------------------------------------------------------------------
+# MAIN
+# ----------------------------------------------------------------------------
+# Start the fake firewalls, run the backup and print the results.
+#
+if __name__ == "__main__":
+    args = get_arguments()
+    args.jobs = args.jobs or args.firewalls
+    settings = {
+        "contexts":          args.contexts,
+        "failover":          not args.no_failover,
+        "latency":           args.latency,
+        "backup_time":       args.backup_time,
+        "bandwidth":         args.bandwidth,
+        "archive_size":      args.archive_size * 1024,
+        "tech_support_size": args.tech_support_size * 1024,
+        "config_lines":      args.config_lines,
+    }
+    home = tempfile.mkdtemp(prefix="asa_benchmark_")
+    backup_dir = os.path.join(home, "backup")
+    os.makedirs(backup_dir)
+    devices = write_config(home, backup_dir, args.firewalls, args.port, args.option)
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve_devices, args=(devices, settings, ready),
+                                     daemon=True)
+    server.start()
+    try:
+        if not ready.wait(60):
+            sys.exit("ERROR: Fake firewalls did not start.")
+        status, seconds, maxrss = run_backup(home, args.jobs, args.engine)
+        print_results(args, status, seconds, maxrss, read_reports(backup_dir), backup_dir)
+    finally:
+        server.terminate()
+        if args.keep:
+            print(f"Backups and log kept in {home}")
+        else:
+            shutil.rmtree(home)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3.11
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------------------------
+# Config comparison benchmark of asa_backup.py.
+# ----------------------------------------------------------------------------
+#
+# Generates a running-config with N object-groups and access-list entries
+# and compares it with compare_files of asa_backup.py in diff-mode text and
+# semantic against variants of it, repeatedly, and reports the time of each
+# comparison. The result of each comparison is checked, e. g. a config
+# with only the members of object-groups in another order must be equal in
+# semantic mode and differ in text mode. Exits with status 1 if a result
+# is wrong.
+#
+# Example:
+#
+#     benchmarks/diff_benchmark.py -r 5 -n 10000
+
+
+
+# ----------------------------------------------------------------------------
+# Import Libraries
+# ----------------------------------------------------------------------------
+
+import argparse
+import importlib.util
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "asa_backup.py")
+
+
+
+# ----------------------------------------------------------------------------
+# load_script
+# ----------------------------------------------------------------------------
+# Import asa_backup.py as module without running its main. Returns module.
+#
+def load_script():
+    spec = importlib.util.spec_from_file_location("asa_backup", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return(module)
+
+
+
+# ----------------------------------------------------------------------------
+# make_config
+# ----------------------------------------------------------------------------
+# Returns the lines of a config with count object-groups of three members
+# each and an access-list entry per object-group. The members are listed in
+# reverse order if reverse is set, the entry of object-group changed (if
+# not None) permits another port.
+#
+def make_config(count, reverse=False, changed=None):
+    lines = [ "hostname bench", "!", "interface GigabitEthernet0/0", " nameif inside", "!" ]
+    for i in range(count):
+        members = [ f" network-object host 10.{i // 256 % 256}.{i % 256}.{j}" for j in (1, 2, 3) ]
+        if reverse:
+            members.reverse()
+        lines += [ f"object-group network servers{i}" ] + members
+    for i in range(count):
+        port = "8443" if i == changed else "443"
+        lines.append(f"access-list inside_in extended permit tcp any object-group servers{i} eq {port}")
+    lines.append("!")
+    return(lines)
+
+
+
+# ----------------------------------------------------------------------------
+# write_configs
+# ----------------------------------------------------------------------------
+# Write the original config and its variants to dir. Returns dict of
+# variant name -> (file name, expected equal in text mode, expected equal
+# in semantic mode).
+#
+def write_configs(dir, count):
+    variants = {
+        "original":  (make_config(count), True, True),
+        "reordered": (make_config(count, reverse=True), False, True),
+        "changed":   (make_config(count, changed=count // 2), False, False),
+    }
+    files = {}
+    for name, (lines, text, semantic) in variants.items():
+        file = f"{name}.cfg"
+        with open(os.path.join(dir, file), 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        files[name] = (file, text, semantic)
+    return(files)
+
+
+
+# ----------------------------------------------------------------------------
+# get_arguments
+# ----------------------------------------------------------------------------
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Measure and check the config comparison of asa_backup.py.")
+    parser.add_argument('-r', '--repeat', type=int, default=5, metavar="N",
+        help="Runs per comparison (default 5).")
+    parser.add_argument('-n', '--groups', type=int, default=1000, metavar="N",
+        help="Number of object-groups in the config (default 1000).")
+    return(parser.parse_args())
+
+
+
+# ----------------------------------------------------------------------------
+# MAIN
+# ----------------------------------------------------------------------------
+if __name__ == "__main__":
+    args = get_arguments()
+    asa_backup = load_script()
+    wrong = []
+    with tempfile.TemporaryDirectory(prefix="asa_diff_") as dir:
+        files = write_configs(dir, args.groups)
+        original = files["original"][0]
+        print(f"Object-groups in config: {args.groups}, runs per comparison: {args.repeat}")
+        print("=" * 80)
+        print(f"{'Variant':<10}  {'Mode':<8}  {'min':>8}  {'median':>8}  {'max':>8}  Result")
+        print("=" * 80)
+        for name, (file, *expected) in files.items():
+            for mode, equal in zip(("text", "semantic"), expected):
+                times = []
+                for _ in range(args.repeat):
+                    start = time.monotonic()
+                    result = asa_backup.compare_files(dir, original, file, mode=mode)
+                    times.append(time.monotonic() - start)
+                if result["error"]:
+                    sys.exit(f"ERROR: {result['error']}")
+                if result["equal"] != equal or (not equal and not result["diff"]):
+                    wrong.append(f"{name} ({mode})")
+                print(f"{name:<10}  {mode:<8}  {min(times) * 1000:>6.1f}ms  "
+                      f"{statistics.median(times) * 1000:>6.1f}ms  {max(times) * 1000:>6.1f}ms  "
+                      f"{'equal' if result['equal'] else 'differ'}, {result['diff_stats']['hunks']} hunks")
+        print("=" * 80)
+    if wrong:
+        sys.exit(f"ERROR: Wrong result of {', '.join(wrong)}.")
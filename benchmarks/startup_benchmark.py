@@ -0,0 +1,173 @@
+#!/usr/bin/env python3.11
+# -*- coding: utf-8 -*-
+
+# ----------------------------------------------------------------------------
+# Startup-time benchmark of asa_backup.py.
+# ----------------------------------------------------------------------------
+#
+# Runs commands of asa_backup.py that never connect to a firewall (--help,
+# list, dry-run, verify) repeatedly in fresh interpreters and reports their
+# wall-clock time next to the bare interpreter startup. Each command is run
+# once more with "python -X importtime" to list the slowest imports and to
+# check that the SSH stack (netmiko, paramiko) and asyncio, which only a
+# backup run needs, are not loaded. Exits with status 1 if they are, with
+# their import time.
+#
+# The config file lists N firewalls, the first one has a small backup in
+# slot daily_0 for verify.
+#
+# Example:
+#
+#     benchmarks/startup_benchmark.py -r 20 -n 1000
+
+
+
+# ----------------------------------------------------------------------------
+# Import Libraries
+# ----------------------------------------------------------------------------
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "asa_backup.py")
+LAZY_MODULES = ( "netmiko", "paramiko", "asyncssh", "cryptography", "asyncio" )
+
+
+
+# ----------------------------------------------------------------------------
+# write_config
+# ----------------------------------------------------------------------------
+# Write a config file with count firewalls to home/.asa_backup.yaml and a
+# backup of the first firewall. Returns the name of the first firewall.
+#
+def write_config(home, count):
+    backup_dir = os.path.join(home, "backup")
+    cfg = {
+        "defaults": {
+            "device-type":     "cisco_asa",
+            "conn-timeout":    30,
+            "read-timeout":    600,
+            "username":        "bench",
+            "password":        "bench",
+            "use-key":         False,
+            "ssh-key":         "~/.ssh/id_rsa",
+            "backup-host":     "127.0.0.1",
+            "backup-username": "bench",
+            "backup-password": "bench",
+            "backup-dir":      backup_dir,
+        },
+        "firewalls": { f"fw{i:05d}": { "hostname": f"fw{i:05d}.example.com", "enable-secret": "bench" }
+                       for i in range(1, count + 1) },
+    }
+    with open(os.path.join(home, ".asa_backup.yaml"), 'w') as file:
+        yaml.safe_dump(cfg, file)
+    slotdir = os.path.join(backup_dir, "fw00001", "daily_0")
+    os.makedirs(slotdir)
+    config = "hostname fw00001\n!\ninterface GigabitEthernet0/0\n nameif inside\n!\n"
+    for file in ("running-config_active.cfg", "startup-config_active.cfg"):
+        with open(os.path.join(slotdir, file), 'w') as f:
+            f.write(config)
+    return("fw00001")
+
+
+
+# ----------------------------------------------------------------------------
+# time_command
+# ----------------------------------------------------------------------------
+# Run a command repeat times with HOME set to home. Returns list of the
+# wall-clock times in seconds. Aborts if the command fails.
+#
+def time_command(home, command, repeat):
+    env = dict(os.environ, HOME=home)
+    times = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        result = subprocess.run(command, env=env, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE, text=True)
+        times.append(time.monotonic() - start)
+        if result.returncode != 0:
+            sys.exit(f"ERROR: {' '.join(command)} failed: {result.stderr}")
+    return(times)
+
+
+
+# ----------------------------------------------------------------------------
+# import_times
+# ----------------------------------------------------------------------------
+# Run a command once with -X importtime. Returns list of tuples (cumulative
+# microseconds, module) of the top-level imports, slowest first.
+#
+def import_times(home, command):
+    env = dict(os.environ, HOME=home)
+    result = subprocess.run(command[:1] + [ "-X", "importtime" ] + command[1:], env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if match := re.match(r'import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)', line):
+            imports.append((int(match.group(1)), len(match.group(2)), match.group(3)))
+    top = min((depth for _, depth, _ in imports), default=0)
+    return(sorted(((us, module) for us, depth, module in imports if depth == top), reverse=True))
+
+
+
+# ----------------------------------------------------------------------------
+# get_arguments
+# ----------------------------------------------------------------------------
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Measure the startup time of asa_backup.py commands without SSH.")
+    parser.add_argument('-r', '--repeat', type=int, default=10, metavar="N",
+        help="Runs per command (default 10).")
+    parser.add_argument('-n', '--firewalls', type=int, default=100, metavar="N",
+        help="Number of firewalls in the config file (default 100).")
+    parser.add_argument('-t', '--top', type=int, default=5, metavar="N",
+        help="Number of slowest imports listed per command (default 5).")
+    return(parser.parse_args())
+
+
+
+# ----------------------------------------------------------------------------
+# MAIN
+# ----------------------------------------------------------------------------
+if __name__ == "__main__":
+    args = get_arguments()
+    python = [ sys.executable ]
+    with tempfile.TemporaryDirectory(prefix="asa_startup_") as home:
+        fw = write_config(home, args.firewalls)
+        commands = {
+            "python":  python + [ "-c", "pass" ],
+            "--help":  python + [ SCRIPT, "--help" ],
+            "list":    python + [ SCRIPT, "list", "-f", fw ],
+            "dry-run": python + [ SCRIPT, "dry-run", "-f", fw ],
+            "verify":  python + [ SCRIPT, "verify", "-f", fw ],
+        }
+        print(f"Firewalls in config: {args.firewalls}, runs per command: {args.repeat}")
+        print("=" * 80)
+        print(f"{'Command':<10}  {'min':>8}  {'median':>8}  {'max':>8}  Lazy modules")
+        print("=" * 80)
+        loaded = []
+        details = {}
+        for name, command in commands.items():
+            times = time_command(home, command, args.repeat)
+            imports = import_times(home, command)
+            lazy = [ f"{m} {us / 1000:.1f}ms" for us, m in imports if m in LAZY_MODULES ]
+            if lazy and name != "python":
+                loaded.append(f"{name} ({', '.join(lazy)})")
+            details[name] = imports
+            print(f"{name:<10}  {min(times) * 1000:>6.1f}ms  {statistics.median(times) * 1000:>6.1f}ms  "
+                  f"{max(times) * 1000:>6.1f}ms  {', '.join(lazy) or 'not loaded'}")
+        print("=" * 80)
+        for name, imports in details.items():
+            if name == "python":
+                continue
+            print(f"Slowest imports of {name}: " + ", ".join(
+                f"{module} {us / 1000:.1f}ms" for us, module in imports[:args.top]))
+    if loaded:
+        sys.exit(f"ERROR: Lazy modules loaded by {', '.join(loaded)}.")